@@ -0,0 +1,99 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import importlib
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from web3 import Web3
+
+import pyflex
+from pyflex import Address
+
+
+def network_config_path(network: str) -> str:
+    """ Location of the addresses pyflex ships for a network, as read by `GfDeployment.from_network` """
+    return os.path.join(os.path.dirname(os.path.realpath(pyflex.__file__)), "..", "config", f"{network}-addresses.json")
+
+
+class LazyDeployment:
+    """ Stands in for a GfDeployment, building each contract object the first time the keeper uses it
+
+    The contracts the keeper calls directly are built on their own, importing only the pyflex module defining them.
+    Anything else, such as `collaterals`, builds the complete GfDeployment once and is read from it.
+    """
+
+    logger = logging.getLogger('lazy-deployment')
+
+    # Attribute -> (pyflex module, class, key in the deployment config)
+    CONTRACTS = {
+        'safe_engine': ('pyflex.gf', 'SAFEEngine', 'GEB_SAFE_ENGINE'),
+        'accounting_engine': ('pyflex.gf', 'AccountingEngine', 'GEB_ACCOUNTING_ENGINE'),
+        'liquidation_engine': ('pyflex.gf', 'LiquidationEngine', 'GEB_LIQUIDATION_ENGINE'),
+        'tax_collector': ('pyflex.gf', 'TaxCollector', 'GEB_TAX_COLLECTOR'),
+        'oracle_relayer': ('pyflex.gf', 'OracleRelayer', 'GEB_ORACLE_RELAYER'),
+        'surplus_auction_house': ('pyflex.auctions', 'PreSettlementSurplusAuctionHouse', 'GEB_SURPLUS_AUCTION_HOUSE'),
+        'debt_auction_house': ('pyflex.auctions', 'DebtAuctionHouse', 'GEB_DEBT_AUCTION_HOUSE'),
+        'global_settlement': ('pyflex.shutdown', 'GlobalSettlement', 'GEB_GLOBAL_SETTLEMENT'),
+        'esm': ('pyflex.shutdown', 'ESM', 'GEB_ESM')
+    }
+
+    def __init__(self, web3: Web3, conf: dict):
+        assert isinstance(web3, Web3)
+        assert isinstance(conf, dict)
+
+        self.web3 = web3
+        self.conf = conf
+        self._deployment = None
+
+    @staticmethod
+    def load(web3: Web3, network: str, deployment_file: Optional[str] = None) -> 'LazyDeployment':
+        """ Reads the deployment config from `deployment_file`, or the one pyflex ships for `network` """
+        with open(deployment_file or network_config_path(network), 'r') as f:
+            return LazyDeployment(web3, json.load(f))
+
+    def address(self, name: str) -> Address:
+        """ Address of a contract, read from the config without building the contract object """
+        return Address(self.conf[self.CONTRACTS[name][2]])
+
+    @property
+    def deployment(self):
+        if self._deployment is None:
+            from pyflex.deployment import GfDeployment
+
+            started = time.time()
+            self._deployment = GfDeployment.from_json(web3=self.web3, conf=json.dumps(self.conf))
+            self.logger.info(f'Loaded the full deployment in {time.time() - started:.2f}s')
+
+        return self._deployment
+
+    def __getattr__(self, name: str):
+        # Only called for attributes not set yet, so each contract is built once
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        if name in self.CONTRACTS:
+            module, contract, key = self.CONTRACTS[name]
+            value = getattr(importlib.import_module(module), contract)(web3=self.web3, address=Address(self.conf[key]))
+        else:
+            value = getattr(self.deployment, name)
+
+        setattr(self, name, value)
+        return value
@@ -0,0 +1,167 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from pyflex import Address
+from pyflex.gf import CollateralType, SAFE
+from pyflex.numeric import Wad
+
+from src.rpc import for_caller, timed_request
+
+
+class GraphSAFEHistory:
+    """ Fetches the SAFEs of a collateral type which have debt from a Graph node
+
+    Filtering on collateral type and debt happens on the server, so the transfer grows with the number of indebted
+    SAFEs rather than with every SAFE ever opened. SAFE ids are split into ranges by their leading hex digit, and
+    each range is paged through with an id cursor, several ranges at a time. With a `block_number`, every page is
+    read as of that block, so SAFEs changing while paging can't be missed or counted twice. Graph nodes trail the
+    chain, so queries for a block not indexed yet are retried for up to `index_wait` seconds.
+    """
+
+    logger = logging.getLogger('graph-safe-history')
+
+    # The Graph refuses to return more than 1000 entities per query
+    MAX_PAGE_SIZE = 1000
+
+    ID_PREFIXES = [f'0x{digit:x}' for digit in range(16)]
+
+    # Fragments of the error a Graph node returns for a block it hasn't indexed yet
+    NOT_INDEXED_ERRORS = ['not yet available', 'indexed up to']
+
+    def __init__(self, graph_endpoint: str, collateral_type: CollateralType, page_size: int = MAX_PAGE_SIZE,
+                 max_workers: int = 4, timeout: int = 60, block_number: Optional[int] = None,
+                 index_wait: float = 300, poll_interval: float = 5):
+        assert isinstance(graph_endpoint, str)
+        assert isinstance(collateral_type, CollateralType)
+        assert 0 < page_size <= self.MAX_PAGE_SIZE
+        assert isinstance(block_number, int) or block_number is None
+
+        self.graph_endpoint = graph_endpoint
+        self.collateral_type = collateral_type
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.block_number = block_number
+        self.index_wait = index_wait
+        self.poll_interval = poll_interval
+        self.session = requests.Session()
+
+    @staticmethod
+    def indexed_block(graph_endpoint: str, timeout: int = 60) -> int:
+        """ Latest block the Graph node has indexed """
+        with timed_request('graph'):
+            response = requests.post(graph_endpoint, json={'query': '{ _meta { block { number } } }'},
+                                     timeout=timeout)
+        response.raise_for_status()
+
+        result = response.json()
+        if result.get('errors'):
+            raise RuntimeError(f"Graph query failed: {result['errors']}")
+
+        return int(result['data']['_meta']['block']['number'])
+
+    @classmethod
+    def id_ranges(cls) -> List[Tuple[str, Optional[str]]]:
+        """ Splits the id space into ranges of (exclusive lower bound, inclusive upper bound) covering every id """
+        lower_bounds = [''] + cls.ID_PREFIXES[1:]
+        upper_bounds = cls.ID_PREFIXES[1:] + [None]
+
+        return list(zip(lower_bounds, upper_bounds))
+
+    @staticmethod
+    def query(bounded: bool, pinned: bool = False) -> str:
+        upper_bound = ', id_lte: $upper' if bounded else ''
+        upper_variable = ', $upper: String!' if bounded else ''
+        block = 'block: {number: $block}, ' if pinned else ''
+        block_variable = ', $block: Int!' if pinned else ''
+
+        return f'''query ($collateralType: String!, $lastId: String!, $first: Int!{upper_variable}{block_variable}) {{
+            safes({block}first: $first, orderBy: id, orderDirection: asc,
+                  where: {{collateralType: $collateralType, debt_gt: 0, id_gt: $lastId{upper_bound}}}) {{
+                id
+                safeHandler
+                collateral
+                debt
+            }}
+        }}'''
+
+    def get_safes(self) -> Dict[Address, SAFE]:
+        started = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            ranges = executor.map(for_caller(lambda bounds: self._fetch_range(*bounds)), self.id_ranges())
+            safes = {safe.address: safe for safes in ranges for safe in safes}
+
+        self.logger.info(f'Fetched {len(safes)} safes with debt of {self.collateral_type.name} '
+                         f'in {time.time() - started:.1f}s')
+        return safes
+
+    def _fetch_range(self, lower: str, upper: Optional[str]) -> List[SAFE]:
+        query = self.query(upper is not None, self.block_number is not None)
+        variables = {'collateralType': self.collateral_type.name, 'lastId': lower, 'first': self.page_size}
+        if upper is not None:
+            variables['upper'] = upper
+        if self.block_number is not None:
+            variables['block'] = self.block_number
+
+        safes = []
+        while True:
+            page = self._post(query, variables)['safes']
+            safes.extend(self._safe(entity) for entity in page)
+
+            if len(page) < self.page_size:
+                return safes
+            variables['lastId'] = page[-1]['id']
+
+    def _post(self, query: str, variables: dict) -> dict:
+        deadline = time.time() + self.index_wait
+        while True:
+            with timed_request('graph'):
+                response = self.session.post(self.graph_endpoint, json={'query': query, 'variables': variables},
+                                             timeout=self.timeout)
+            response.raise_for_status()
+
+            result = response.json()
+            if not result.get('errors'):
+                return result['data']
+
+            if self._not_indexed(result['errors']) and time.time() < deadline:
+                self.logger.info(f'Waiting for the Graph node to index block {self.block_number}')
+                time.sleep(self.poll_interval)
+                continue
+
+            raise RuntimeError(f"Graph query failed: {result['errors']}")
+
+    def _not_indexed(self, errors: list) -> bool:
+        message = str(errors).lower()
+        return self.block_number is not None and any(fragment in message for fragment in self.NOT_INDEXED_ERRORS)
+
+    def _safe(self, entity: dict) -> SAFE:
+        return SAFE(Address(entity['safeHandler']), self.collateral_type,
+                    self._wad(entity['collateral']), self._wad(entity['debt']))
+
+    @staticmethod
+    def _wad(amount: str) -> Wad:
+        return Wad(int(Decimal(amount) * 10**18))
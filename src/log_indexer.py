@@ -0,0 +1,219 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Optional
+
+from src.rpc import for_caller, timed_request
+
+
+def raw_get_logs(web3) -> Callable[[dict], list]:
+    """ Returns a function calling `eth_getLogs` straight through the provider, skipping web3 result formatting """
+
+    def get_logs(params: dict) -> list:
+        params = dict(params, fromBlock=hex(params['fromBlock']), toBlock=hex(params['toBlock']))
+        # Past web3's middleware, so it is counted here
+        with timed_request('eth_getLogs'):
+            response = web3.provider.make_request('eth_getLogs', [params])
+        if 'error' in response:
+            raise ValueError(response['error'])
+
+        return response['result']
+
+    return get_logs
+
+
+class LogConsumer:
+    """ Receives the logs of a scan in block order and provides the state saved in checkpoints """
+
+    def consume(self, logs: list):
+        raise NotImplementedError()
+
+    def to_checkpoint(self):
+        """ Returns a JSON-serializable representation of everything consumed so far """
+        raise NotImplementedError()
+
+    def from_checkpoint(self, state):
+        raise NotImplementedError()
+
+
+class LogIndexer:
+    """ Fetches the logs matching a filter over a block range in adaptively sized chunks
+
+    Chunks shrink when the node rejects or times out on a range and grow again over sparse ranges. Several chunks
+    are fetched at once, and progress is checkpointed so an interrupted scan resumes where it stopped.
+
+    Checkpoints never hold logs from the last `confirmations` blocks of a scan, so a reorg of those blocks can't
+    leave logs of orphaned blocks in a resumed scan. A checkpoint reaching past the end of a later scan is
+    discarded, as its state can't be unwound to that earlier block.
+    """
+
+    logger = logging.getLogger('log-indexer')
+
+    # Fragments of the errors nodes return when a range holds too many logs or takes too long to serve
+    RANGE_ERRORS = ['more than', 'too many', 'limit exceeded', 'response size', 'range', 'timeout', 'timed out']
+
+    MAX_CHUNK_SIZE = 1000000
+
+    def __init__(self, get_logs: Callable[[dict], list], chunk_size: int = 20000, min_chunk_size: int = 1,
+                 max_chunk_size: int = MAX_CHUNK_SIZE, sparse_results: int = 1000, max_workers: int = 4,
+                 checkpoint_file: Optional[str] = None, checkpoint_interval: int = 10, confirmations: int = 12):
+        assert callable(get_logs)
+        assert 0 < min_chunk_size <= chunk_size <= max_chunk_size
+        assert max_workers > 0
+        assert confirmations >= 0
+
+        if checkpoint_file is not None and os.path.dirname(checkpoint_file):
+            os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+
+        self.get_logs = get_logs
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.sparse_results = sparse_results
+        self.max_workers = max_workers
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.confirmations = confirmations
+
+    def scan(self, filter_params: dict, from_block: int, to_block: int, consumer: LogConsumer):
+        """ Feeds every log matching `filter_params` between `from_block` and `to_block` (inclusive) to `consumer` """
+        assert isinstance(filter_params, dict)
+        assert isinstance(consumer, LogConsumer)
+
+        frontier = self._resume(filter_params, from_block, to_block, consumer)
+        next_block = frontier
+        # Last block whose logs may go into a checkpoint
+        confirmed_block = to_block - self.confirmations
+        confirmed_state = None
+        chunk_size = self.chunk_size
+        retries = deque()
+        in_flight = {}
+        completed = {}
+        last_checkpoint = time.time()
+        started = time.time()
+
+        if frontier > from_block:
+            self.logger.info(f'Resuming log scan from block {frontier}')
+
+        # Requests made by the workers count towards the thread running the scan
+        get_logs = for_caller(self.get_logs)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while frontier <= to_block:
+                # Don't run ahead too far while an earlier range is still being retried
+                while len(in_flight) < self.max_workers and \
+                        (retries or (next_block <= to_block and len(completed) < 4 * self.max_workers)):
+                    if retries:
+                        start, end = retries.popleft()
+                    else:
+                        start, end = next_block, min(next_block + chunk_size - 1, to_block)
+                        # Chunks end at the last confirmed block, so the scan passes through it
+                        if start <= confirmed_block < end:
+                            end = confirmed_block
+                        next_block = end + 1
+
+                    params = dict(filter_params, fromBlock=start, toBlock=end)
+                    in_flight[executor.submit(get_logs, params)] = (start, end)
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start, end = in_flight.pop(future)
+                    try:
+                        logs = future.result()
+                    except Exception as e:
+                        if start == end or not self._is_range_error(e):
+                            raise
+
+                        middle = (start + end) // 2
+                        retries.appendleft((middle + 1, end))
+                        retries.appendleft((start, middle))
+                        chunk_size = max(self.min_chunk_size, min(chunk_size, (end - start + 1) // 2))
+                        self.logger.debug(f'Blocks {start}-{end} rejected ({e}), reducing chunk size to {chunk_size}')
+                        continue
+
+                    completed[start] = (end, logs)
+                    if len(logs) < self.sparse_results and end - start + 1 >= chunk_size:
+                        chunk_size = min(self.max_chunk_size, chunk_size * 2)
+
+                while frontier in completed:
+                    end, logs = completed.pop(frontier)
+                    consumer.consume(logs)
+                    frontier = end + 1
+                    if frontier - 1 == confirmed_block and self.checkpoint_file is not None:
+                        # A copy, as the consumer goes on to fold in the unconfirmed blocks
+                        confirmed_state = json.loads(json.dumps(consumer.to_checkpoint()))
+
+                if time.time() - last_checkpoint >= self.checkpoint_interval and frontier - 1 <= confirmed_block:
+                    self._checkpoint(filter_params, from_block, frontier, consumer.to_checkpoint())
+                    last_checkpoint = time.time()
+                    self.logger.info(f'Scanned logs up to block {frontier - 1} of {to_block}')
+
+        if confirmed_state is not None:
+            self._checkpoint(filter_params, from_block, confirmed_block + 1, confirmed_state)
+        elif frontier - 1 <= confirmed_block:
+            self._checkpoint(filter_params, from_block, frontier, consumer.to_checkpoint())
+        self.logger.info(f'Scanned logs from block {from_block} to {to_block} in {time.time() - started:.1f}s')
+
+    def _is_range_error(self, e: Exception) -> bool:
+        message = str(e).lower()
+        return any(fragment in message for fragment in self.RANGE_ERRORS)
+
+    @staticmethod
+    def _filter_key(filter_params: dict) -> str:
+        return json.dumps(filter_params, sort_keys=True, default=str)
+
+    def _resume(self, filter_params: dict, from_block: int, to_block: int, consumer: LogConsumer) -> int:
+        if self.checkpoint_file is None or not os.path.exists(self.checkpoint_file):
+            return from_block
+
+        with open(self.checkpoint_file, 'r') as f:
+            checkpoint = json.load(f)
+
+        if checkpoint['filter'] != self._filter_key(filter_params) or checkpoint['from_block'] != from_block:
+            self.logger.warning(f'Ignoring checkpoint {self.checkpoint_file} which was written for a different scan')
+            return from_block
+
+        if checkpoint['next_block'] - 1 > to_block:
+            self.logger.warning(f'Ignoring checkpoint {self.checkpoint_file}, which holds logs up to block '
+                                f'{checkpoint["next_block"] - 1}, past the end of this scan at block {to_block}')
+            return from_block
+
+        consumer.from_checkpoint(checkpoint['state'])
+        return checkpoint['next_block']
+
+    def _checkpoint(self, filter_params: dict, from_block: int, next_block: int, state):
+        if self.checkpoint_file is None:
+            return
+
+        checkpoint = {
+            'filter': self._filter_key(filter_params),
+            'from_block': from_block,
+            'next_block': next_block,
+            'state': state
+        }
+
+        # Write then rename, so an interruption never leaves a truncated checkpoint behind
+        temporary_file = f'{self.checkpoint_file}.tmp'
+        with open(temporary_file, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temporary_file, self.checkpoint_file)
@@ -0,0 +1,183 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cProfile
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List
+
+from src.rpc import requests_made, rpc_seconds
+
+
+class PhaseStats:
+    def __init__(self):
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.rpc_seconds = 0.0
+        self.requests = 0
+
+
+class PhaseProfiler:
+    """ Profiles each keeper phase on its own, writing the results to a directory
+
+    In `sampling` mode, a background thread records the stack of every thread inside a phase every `interval`
+    seconds, and each phase's samples are written as `<phase>.collapsed`, one `frame;frame;frame count` line per
+    stack, which flamegraph.pl and speedscope read. In `deterministic` mode each phase gets a cProfile profile,
+    written as `<phase>.pstats`. A nested phase pauses the profile of the phase it was called from, so a phase's
+    profile only holds its own work.
+
+    Either way, `summary.txt` holds the calls, wall time and time spent waiting on JSON-RPC and Graph requests of
+    each phase, including nested phases and the requests worker threads made for it. Parallel requests each add
+    their own time, so a phase's request time can exceed its wall time. The summary is rewritten whenever an
+    outermost phase ends, the profiles once the profiler is closed.
+    """
+
+    logger = logging.getLogger('phase-profiler')
+
+    MODES = ['sampling', 'deterministic']
+
+    def __init__(self, directory: str, mode: str = 'sampling', interval: float = 0.005):
+        assert isinstance(directory, str)
+        assert mode in self.MODES
+        assert interval > 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.stats: Dict[str, PhaseStats] = OrderedDict()
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.samples: Dict[str, Counter] = {}
+        self._active: Dict[int, List[str]] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = None
+
+        if mode == 'sampling':
+            self._sampler = threading.Thread(target=self._sample, name='phase-profiler', daemon=True)
+            self._sampler.start()
+
+    @contextmanager
+    def phase(self, name: str):
+        thread_id = threading.get_ident()
+        with self._lock:
+            stack = self._active.setdefault(thread_id, [])
+            parent = stack[-1] if stack else None
+            stack.append(name)
+            stats = self.stats.setdefault(name, PhaseStats())
+
+        if self.mode == 'deterministic':
+            if parent is not None:
+                self.profiles[parent].disable()
+            self.profiles.setdefault(name, cProfile.Profile()).enable()
+
+        started = time.perf_counter()
+        started_rpc = rpc_seconds()
+        started_requests = sum(requests_made().values())
+        try:
+            yield
+        finally:
+            stats.calls += 1
+            stats.wall_seconds += time.perf_counter() - started
+            stats.rpc_seconds += rpc_seconds() - started_rpc
+            stats.requests += sum(requests_made().values()) - started_requests
+
+            if self.mode == 'deterministic':
+                self.profiles[name].disable()
+                if parent is not None:
+                    self.profiles[parent].enable()
+
+            with self._lock:
+                stack.pop()
+                outermost = not stack
+
+            # Written once the outermost phase ends, so the summary is on disk even if the keeper is killed
+            if outermost:
+                self.write_summary()
+
+    def wrap(self, obj, names: List[str]):
+        """ Replaces each named method of `obj` with one running inside a phase of the same name """
+        for name in names:
+            setattr(obj, name, self._profiled(getattr(obj, name), name))
+
+    def _profiled(self, method, name: str):
+        @functools.wraps(method)
+        def profiled(*args, **kwargs):
+            with self.phase(name):
+                return method(*args, **kwargs)
+
+        return profiled
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stack in self._active.items():
+                    if stack and thread_id in frames:
+                        self.samples.setdefault(stack[-1], Counter())[self._collapse(frames[thread_id])] += 1
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+
+        return ';'.join(reversed(names))
+
+    def summary(self) -> str:
+        lines = [f'{"phase":<32} {"calls":>7} {"wall s":>10} {"rpc s":>10} {"rpc %":>6} {"requests":>9}']
+        for name, stats in self.stats.items():
+            rpc_share = 100 * stats.rpc_seconds / stats.wall_seconds if stats.wall_seconds else 0
+            lines.append(f'{name:<32} {stats.calls:>7} {stats.wall_seconds:>10.3f} {stats.rpc_seconds:>10.3f} '
+                         f'{rpc_share:>6.1f} {stats.requests:>9}')
+
+        return '\n'.join(lines)
+
+    def write(self):
+        with self._lock:
+            samples = {name: Counter(counts) for name, counts in self.samples.items()}
+
+        for name, counts in samples.items():
+            with open(os.path.join(self.directory, f'{name}.collapsed'), 'w') as f:
+                for stack, count in counts.most_common():
+                    f.write(f'{stack} {count}\n')
+
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(self.directory, f'{name}.pstats'))
+
+        self.write_summary()
+
+    def write_summary(self):
+        with open(os.path.join(self.directory, 'summary.txt'), 'w') as f:
+            f.write(self.summary() + '\n')
+
+    def close(self):
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+        self.write()
+        self.logger.info(f'Profiles written to {self.directory}\n{self.summary()}')
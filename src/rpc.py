@@ -0,0 +1,265 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from web3 import Web3, HTTPProvider
+from web3._utils.request import make_post_request
+
+from pyflex import Address
+
+_pinned = threading.local()
+_requests = threading.local()
+
+# Methods reading state, and the position of their block parameter
+BLOCK_PARAMETERS = {
+    'eth_call': 1,
+    'eth_getBalance': 1,
+    'eth_getCode': 1,
+    'eth_getStorageAt': 2,
+    'eth_getTransactionCount': 1
+}
+
+
+def pinned_block() -> Optional[int]:
+    return getattr(_pinned, 'block_number', None)
+
+
+@contextmanager
+def pinned_to(block_number: int):
+    """ Makes every state read of the current thread, made while inside the block, read at `block_number` """
+    assert isinstance(block_number, int)
+
+    previous = pinned_block()
+    _pinned.block_number = block_number
+    try:
+        yield
+    finally:
+        _pinned.block_number = previous
+
+
+def pinned_block_middleware(make_request, web3):
+    """ Rewrites reads of the `latest` block to the block the current thread is pinned to, if any """
+
+    def middleware(method, params):
+        block_number = pinned_block()
+        if block_number is None:
+            return make_request(method, params)
+
+        # Request formatting may already have happened, so the block goes in as a quantity
+        position = BLOCK_PARAMETERS.get(method)
+        if position is not None:
+            params = list(params)
+            if len(params) == position:
+                params.append(hex(block_number))
+            elif params[position] == 'latest':
+                params[position] = hex(block_number)
+
+        return make_request(method, params)
+
+    return middleware
+
+
+class RequestTally:
+    """ Requests made on behalf of one thread, by method, and the time spent on them """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+
+def _tally() -> RequestTally:
+    if not hasattr(_requests, 'tally'):
+        _requests.tally = RequestTally()
+
+    return _requests.tally
+
+
+def requests_made() -> Counter:
+    """ Requests the current thread made since `reset_requests`, by method """
+    tally = _tally()
+    with tally.lock:
+        return Counter(tally.counts)
+
+
+def reset_requests():
+    tally = _tally()
+    with tally.lock:
+        tally.counts.clear()
+
+
+def count_request(method: str):
+    tally = _tally()
+    with tally.lock:
+        tally.counts[method] += 1
+
+
+def rpc_seconds() -> float:
+    """ Time the current thread has spent waiting on JSON-RPC requests, in total """
+    return _tally().seconds
+
+
+def add_rpc_seconds(seconds: float):
+    tally = _tally()
+    with tally.lock:
+        tally.seconds += seconds
+
+
+@contextmanager
+def timed_request(method: str):
+    """ Counts a request made outside of web3's middleware, such as a raw provider call or a Graph query """
+    count_request(method)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_rpc_seconds(time.perf_counter() - started)
+
+
+def for_caller(function: Callable) -> Callable:
+    """ Makes the requests of `function` count towards the calling thread, when it is run on a worker thread """
+    tally = _tally()
+
+    @functools.wraps(function)
+    def on_behalf_of_caller(*args, **kwargs):
+        previous = getattr(_requests, 'tally', None)
+        _requests.tally = tally
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if previous is None:
+                del _requests.tally
+            else:
+                _requests.tally = previous
+
+    return on_behalf_of_caller
+
+
+def request_counter_middleware(make_request, web3):
+    """ Counts the requests made by each thread, and the time spent on them, so a keeper can tell what a block
+        cost it
+    """
+
+    def middleware(method, params):
+        with timed_request(method):
+            return make_request(method, params)
+
+    return middleware
+
+
+def install_middleware(web3: Web3):
+    """ Adds the keeper's middleware to a Web3 instance, once even when keepers share it """
+    if 'pinned_block' not in web3.middleware_onion:
+        web3.middleware_onion.add(pinned_block_middleware, 'pinned_block')
+    if 'request_counter' not in web3.middleware_onion:
+        web3.middleware_onion.add(request_counter_middleware, 'request_counter')
+
+
+class Status:
+    def __init__(self, block_number: int, timestamp: int, contract_enabled: bool, shutdown_time: int,
+                 shutdown_cooldown: int):
+        self.block_number = block_number
+        self.timestamp = timestamp
+        self.contract_enabled = contract_enabled
+        self.shutdown_time = shutdown_time
+        self.shutdown_cooldown = shutdown_cooldown
+
+    def __repr__(self):
+        return f"Status({self.block_number}, contract_enabled={self.contract_enabled}, " \
+               f"shutdown_time={self.shutdown_time}, shutdown_cooldown={self.shutdown_cooldown})"
+
+
+class StatusProbe:
+    """ Reads the latest block and the GlobalSettlement status in one batched JSON-RPC request
+
+    `shutdownTime` and `shutdownCooldown` no longer change once the system has been shut down, so they are
+    only asked for until they are set. Providers other than HTTP get the same reads as separate requests.
+    """
+
+    logger = logging.getLogger('status-probe')
+
+    SELECTORS = {name: Web3.keccak(text=f'{name}()').hex()[:10]
+                 for name in ['contractEnabled', 'shutdownTime', 'shutdownCooldown']}
+
+    def __init__(self, web3: Web3, global_settlement: Address):
+        assert isinstance(web3, Web3)
+        assert isinstance(global_settlement, Address)
+
+        self.web3 = web3
+        self.global_settlement = global_settlement
+        self.shutdown_time = None
+        self.shutdown_cooldown = None
+
+    def probe(self) -> Status:
+        calls = ['contractEnabled'] if self.shutdown_time is not None else \
+            ['contractEnabled', 'shutdownTime', 'shutdownCooldown']
+        requests = [('eth_getBlockByNumber', ['latest', False])] + \
+                   [('eth_call', [{'to': self.global_settlement.address, 'data': self.SELECTORS[call]}, 'latest'])
+                    for call in calls]
+
+        results = self._batch(requests) if isinstance(self.web3.provider, HTTPProvider) else self._each(requests)
+        block = results[0]
+        values = dict(zip(calls, [int(result, 16) for result in results[1:]]))
+
+        if self.shutdown_time is None and values['shutdownTime'] != 0:
+            self.shutdown_time = values['shutdownTime']
+            self.shutdown_cooldown = values['shutdownCooldown']
+
+        return Status(block_number=int(block['number'], 16),
+                      timestamp=int(block['timestamp'], 16),
+                      contract_enabled=values['contractEnabled'] != 0,
+                      shutdown_time=self.shutdown_time or 0,
+                      shutdown_cooldown=self.shutdown_cooldown or 0)
+
+    def _batch(self, requests: list) -> list:
+        payload = [{'jsonrpc': '2.0', 'method': method, 'params': params, 'id': id}
+                   for id, (method, params) in enumerate(requests)]
+
+        # Through the session web3 keeps for the endpoint, so the batch reuses the provider's connection
+        with timed_request('batch'):
+            raw_response = make_post_request(self.web3.provider.endpoint_uri, json.dumps(payload).encode('utf-8'),
+                                             **self.web3.provider.get_request_kwargs())
+        responses = json.loads(raw_response)
+        if isinstance(responses, dict):
+            raise ValueError(responses.get('error', responses))
+        responses = {response['id']: response for response in responses}
+
+        return [self._result(responses[id]) for id in range(len(requests))]
+
+    def _each(self, requests: list) -> list:
+        results = []
+        for method, params in requests:
+            # Past web3's middleware, so each request is counted here
+            with timed_request(method):
+                results.append(self._result(self.web3.provider.make_request(method, params)))
+
+        return results
+
+    @staticmethod
+    def _result(response: dict):
+        if 'error' in response:
+            raise ValueError(response['error'])
+
+        return response['result']
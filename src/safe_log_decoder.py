@@ -0,0 +1,135 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from typing import Dict, List
+
+from web3 import Web3
+
+from src.log_indexer import LogConsumer
+
+
+def event_topic(abi: list, name: str) -> str:
+    """ Returns topic0 of the event `name` as declared in a contract ABI """
+    event = _event_abi(abi, name)
+    signature = f"{name}({','.join(i['type'] for i in event['inputs'])})"
+
+    return Web3.keccak(text=signature).hex()
+
+
+def collateral_type_topic(name: str) -> str:
+    return '0x' + name.encode('utf-8').ljust(32, b'\x00').hex()
+
+
+def _event_abi(abi: list, name: str) -> dict:
+    return next(entry for entry in abi if entry.get('type') == 'event' and entry['name'] == name)
+
+
+class SAFELogDecoder(LogConsumer):
+    """ Folds raw SAFEEngine logs into per-SAFE locked collateral and generated debt totals in a single pass
+
+    Only the three events which change a SAFE are understood. Logs are expected as returned by `eth_getLogs`,
+    before any web3 formatting: fields are read by slicing the hex encoded topics and data words, and no
+    per-log objects are created.
+    """
+
+    # Event name -> (SAFE argument, sign applied to the deltas)
+    EVENTS = {
+        'ModifySAFECollateralization': [('safe', 1)],
+        'ConfiscateSAFECollateralAndDebt': [('safe', 1)],
+        'TransferSAFECollateralAndDebt': [('src', -1), ('dst', 1)]
+    }
+
+    def __init__(self, abi: list):
+        assert isinstance(abi, list)
+
+        self._layouts = {}
+        for name, safes in self.EVENTS.items():
+            locations = self._locations(_event_abi(abi, name))
+            self._layouts[event_topic(abi, name)] = (
+                [(locations[argument], sign) for argument, sign in safes],
+                locations['deltaCollateral'],
+                locations['deltaDebt']
+            )
+
+        self.totals: Dict[str, List[int]] = {}
+        self.decoded = 0
+        self.elapsed = 0.0
+
+    @property
+    def topics(self) -> List[str]:
+        return list(self._layouts.keys())
+
+    @staticmethod
+    def _locations(event: dict) -> dict:
+        """ Maps each argument to where it's found: (True, topic index) or (False, character offset in the data) """
+        locations = {}
+        topic = 1
+        word = 0
+        for argument in event['inputs']:
+            if argument['indexed']:
+                locations[argument['name']] = (True, topic)
+                topic += 1
+            else:
+                locations[argument['name']] = (False, 2 + 64 * word)
+                word += 1
+
+        return locations
+
+    @staticmethod
+    def _word(log: dict, location: tuple) -> str:
+        indexed, position = location
+        return log['topics'][position] if indexed else log['data'][position:position + 64]
+
+    def _int(self, log: dict, location: tuple) -> int:
+        value = int(self._word(log, location), 16)
+        return value - 2**256 if value >= 2**255 else value
+
+    def consume(self, logs: list):
+        started = time.perf_counter()
+
+        totals = self.totals
+        for log in logs:
+            layout = self._layouts.get(log['topics'][0])
+            if layout is None:
+                continue
+
+            safes, delta_collateral_location, delta_debt_location = layout
+            delta_collateral = self._int(log, delta_collateral_location)
+            delta_debt = self._int(log, delta_debt_location)
+
+            for location, sign in safes:
+                address = self._word(log, location)[-40:].lower()
+                total = totals.get(address)
+                if total is None:
+                    total = totals[address] = [0, 0]
+                total[0] += sign * delta_collateral
+                total[1] += sign * delta_debt
+
+        self.decoded += len(logs)
+        self.elapsed += time.perf_counter() - started
+
+    @property
+    def logs_per_second(self) -> float:
+        return self.decoded / self.elapsed if self.elapsed > 0 else 0.0
+
+    def to_checkpoint(self):
+        return self.totals
+
+    def from_checkpoint(self, state):
+        self.totals = {address: list(total) for address, total in state.items()}
+
@@ -0,0 +1,71 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from typing import Dict, Optional
+
+from web3 import Web3
+
+from pyflex import Address
+from pyflex.gf import CollateralType, SAFE
+from pyflex.numeric import Wad
+
+from src.log_indexer import LogIndexer
+from src.safe_log_decoder import SAFELogDecoder, collateral_type_topic
+
+
+class SAFELogHistory:
+    """ Discovers the SAFEs of a collateral type from SAFEEngine logs, without a Graph node """
+
+    logger = logging.getLogger('safe-log-history')
+
+    def __init__(self, web3: Web3, geb, collateral_type: CollateralType, from_block: int,
+                 indexer: LogIndexer, to_block: Optional[int] = None):
+        assert isinstance(web3, Web3)
+        assert isinstance(collateral_type, CollateralType)
+        assert isinstance(from_block, int)
+        assert isinstance(indexer, LogIndexer)
+        assert isinstance(to_block, int) or to_block is None
+
+        self.web3 = web3
+        self.geb = geb
+        self.collateral_type = collateral_type
+        self.from_block = from_block
+        self.indexer = indexer
+        self.to_block = to_block
+
+    def get_safes(self) -> Dict[Address, SAFE]:
+        """ Returns every SAFE of the collateral type ever modified up to `to_block`, or the latest block,
+            with totals folded from its logs
+        """
+        decoder = SAFELogDecoder(self.geb.safe_engine.abi)
+        filter_params = {
+            'address': self.geb.safe_engine.address.address,
+            'topics': [decoder.topics, collateral_type_topic(self.collateral_type.name)]
+        }
+
+        to_block = self.to_block if self.to_block is not None else self.web3.eth.blockNumber
+        self.indexer.scan(filter_params, self.from_block, to_block, decoder)
+        self.logger.info(f'Decoded {decoder.decoded} logs of {self.collateral_type.name} '
+                         f'({decoder.logs_per_second:.0f} logs/s)')
+
+        safes = {}
+        for address, (locked_collateral, generated_debt) in decoder.totals.items():
+            address = Address(f'0x{address}')
+            safes[address] = SAFE(address, self.collateral_type, Wad(locked_collateral), Wad(generated_debt))
+
+        return safes
@@ -0,0 +1,131 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class SettlementJournal:
+    """ Append-only record of settlement progress, replayed on startup to resume where the keeper stopped
+
+    Each line is a JSON record, either a keeper state change or the planning, sending, mining or failure of a
+    settlement action. Records are flushed and synced before the keeper moves on, so a crash loses at most the
+    line being written, which is skipped on replay. Without a path the journal only lives in memory.
+    """
+
+    logger = logging.getLogger('settlement-journal')
+
+    PLANNED = 'planned'
+    SENT = 'sent'
+    MINED = 'mined'
+    FAILED = 'failed'
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.state = {}
+        self.actions = OrderedDict()
+
+        if path is not None and os.path.exists(path):
+            self._replay()
+
+        self._file = open(path, 'a') if path is not None else None
+
+        # Terminate a record cut short by a crash, so it doesn't swallow the next one
+        if self._file is not None and self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+
+    @staticmethod
+    def key(action: str, params: list) -> str:
+        return ':'.join([action] + [str(param) for param in params])
+
+    def _replay(self):
+        records = 0
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.logger.warning(f'Skipping incomplete journal record: {line.strip()}')
+                    continue
+
+                self._apply(record)
+                records += 1
+
+        self.logger.info(f'Replayed {records} records from {self.path}: {len(self.pending())} of '
+                         f'{len(self.actions)} settlement actions pending')
+
+    def _apply(self, record: dict):
+        if record['type'] == 'state':
+            self.state[record['name']] = record['value']
+            return
+
+        key = record['key']
+        if record['type'] == self.PLANNED:
+            self.actions.setdefault(key, {'action': record['action'], 'params': record['params'],
+                                          'status': self.PLANNED, 'tx_hashes': []})
+        else:
+            action = self.actions[key]
+            action['status'] = record['type']
+            if record.get('tx_hash') and record['tx_hash'] not in action['tx_hashes']:
+                action['tx_hashes'].append(record['tx_hash'])
+
+    def _append(self, record: dict):
+        self._apply(record)
+
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def set(self, name: str, value):
+        if self.state.get(name) != value:
+            self._append({'type': 'state', 'name': name, 'value': value})
+
+    def plan(self, action: str, params: list) -> str:
+        """ Records that an action will be sent, unless it already was planned, and returns its key """
+        key = self.key(action, params)
+        if key not in self.actions:
+            self._append({'type': self.PLANNED, 'key': key, 'action': action, 'params': params})
+
+        return key
+
+    def sent(self, key: str, tx_hash: str):
+        self._append({'type': self.SENT, 'key': key, 'tx_hash': tx_hash})
+
+    def mined(self, key: str, tx_hash: Optional[str]):
+        self._append({'type': self.MINED, 'key': key, 'tx_hash': tx_hash})
+
+    def failed(self, key: str):
+        self._append({'type': self.FAILED, 'key': key})
+
+    def status(self, key: str) -> Optional[str]:
+        return self.actions[key]['status'] if key in self.actions else None
+
+    def pending(self) -> List[str]:
+        """ Keys of the actions not known to be mined, in the order they were planned """
+        return [key for key, action in self.actions.items() if action['status'] != self.MINED]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -15,25 +15,57 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+
+# Taken before the heavier imports below, to measure how long the keeper takes to start
+started_at = time.time()
+
 import argparse
+import asyncio
 import logging
+import os
 import sys
-from datetime import datetime, timezone
-from typing import List
+from datetime import datetime
+from typing import List, Optional, TYPE_CHECKING
 
 from web3 import Web3, HTTPProvider
+from web3.exceptions import BlockNotFound, TransactionNotFound
 
-from pyflex import Address
+from pyflex import Address, Transact
 from pyflex.gas import DefaultGasPrice
-from pyflex.auctions import FixedDiscountCollateralAuctionHouse, EnglishCollateralAuctionHouse
 from pyflex.keys import register_keys
 from pyflex.lifecycle import Lifecycle
-from pyflex.numeric import Wad, Rad, Ray
-from pyflex.deployment import GfDeployment
-from pyflex.gf import CollateralType, SAFE
+from pyflex.numeric import Wad, Rad
+
+from src.deployment import LazyDeployment
+from src.log_indexer import LogIndexer, raw_get_logs
+from src.profiling import PhaseProfiler
+from src.rpc import StatusProbe, install_middleware, requests_made, reset_requests
+from src.settlement_journal import SettlementJournal
+from src.settlement_snapshot import SettlementSnapshot
+
+# pyflex.gf loads the ABI of every core contract when imported, so it and the modules using it are only imported
+# by the phases needing them
+if TYPE_CHECKING:
+    from pyflex.gf import CollateralType, SAFE
+    from src.snapshot_file import SnapshotFile
+
+imported_at = time.time()
+
+
+def int_between(minimum: int, maximum: Optional[int] = None):
+    """ Argument type accepting integers from `minimum` up to `maximum`, so bad values stop the keeper at startup
+        rather than once settlement needs them
+    """
+    def integer(value: str) -> int:
+        number = int(value)
+        if number < minimum or (maximum is not None and number > maximum):
+            bounds = f'between {minimum} and {maximum}' if maximum is not None else f'at least {minimum}'
+            raise argparse.ArgumentTypeError(f'{value} is not {bounds}')
+        return number
+
+    return integer
 
-from auction_keeper.safe_history import SAFEHistory
-from auction_keeper.gas import DynamicGasPrice
 
 class SettlementKeeper:
     """Keeper to facilitate Emergency Shutdown"""
@@ -57,10 +89,24 @@ class SettlementKeeper:
         parser.add_argument('--previous-settlement', dest='settlement_facilitated', action='store_true',
                             help='Include this argument if this keeper previously helped to facilitate the processing phase of ES')
 
+        parser.add_argument("--journal-file", type=str, default=None,
+                            help="Append-only file in which settlement progress is recorded; when it exists, the keeper "
+                                 "resumes from it instead of starting the processing period over")
+
         parser.add_argument("--graph-endpoint", type=str, default=None,
                             help="When specified, safe history will be initialized from a Graph node, "
                                  "reducing load on the Ethereum node for collateral auctions")
 
+        parser.add_argument("--graph-page-size", type=int_between(1, 1000), default=1000,
+                            help="Number of safes requested per Graph query (default: 1000, the Graph's maximum)")
+
+        parser.add_argument("--export-snapshot", type=str, default=None,
+                            help="Write the settlement state of the latest block to this file, then exit")
+
+        parser.add_argument("--snapshot-file", type=str, default=None,
+                            help="Settlement state written by --export-snapshot, used instead of reading it from "
+                                 "the chain when its block is still canonical and after shutdown")
+
         parser.add_argument("--eth-from", type=str, required=True,
                             help="Ethereum address from which to send transactions; checksummed (e.g. '0x12AebC')")
 
@@ -73,9 +119,33 @@ class SettlementKeeper:
         parser.add_argument("--safe-engine-deployment-block", type=int, required=False, default=0,
                             help="Block that the SAFEEngine from gf-deployment-file was deployed at (e.g. 8836668")
 
+        parser.add_argument("--log-chunk-size", type=int_between(1, LogIndexer.MAX_CHUNK_SIZE), default=20000,
+                            help="Initial number of blocks per eth_getLogs request when discovering safes without "
+                                 "a Graph node; adapted to what the node accepts (default: 20000)")
+
+        parser.add_argument("--log-checkpoint-dir", type=str, default=None,
+                            help="Directory in which safe discovery progress is checkpointed, so an interrupted "
+                                 "log scan resumes where it stopped")
+
+        parser.add_argument("--max-workers", type=int_between(1), default=4,
+                            help="Maximum number of concurrent requests made while discovering safes (default: 4)")
+
+        parser.add_argument("--rpc-budget", type=int, default=None,
+                            help="Number of JSON-RPC and Graph requests per block above which a warning is logged; "
+                                 "the batched status probe made every block counts as one. The block polling of the "
+                                 "keeper lifecycle runs on its own thread and is not counted")
+
         parser.add_argument("--max-errors", type=int, default=100,
                             help="Maximum number of allowed errors before the keeper terminates (default: 100)")
 
+        parser.add_argument("--profile", type=str, default=None,
+                            help="Directory to which a profile of each keeper phase is written, along with a summary "
+                                 "of the wall time and JSON-RPC time of each phase")
+
+        parser.add_argument("--profile-mode", type=str, choices=PhaseProfiler.MODES, default='sampling',
+                            help="Whether --profile samples stacks into flamegraph input, or records every call with "
+                                 "cProfile into pstats files (default: sampling)")
+
         parser.add_argument("--debug", dest='debug', action='store_true',
                             help="Enable debug output")
 
@@ -94,26 +164,43 @@ class SettlementKeeper:
                                   request_kwargs={"timeout": self.arguments.rpc_timeout}))
 
         self.web3.eth.defaultAccount = self.arguments.eth_from
+        install_middleware(self.web3)
         register_keys(self.web3, self.arguments.eth_key)
         self.our_address = Address(self.arguments.eth_from)
 
-        if self.arguments.gf_deployment_file:
-            self.geb = GfDeployment.from_json(web3=self.web3, conf=open(self.arguments.gf_deployment_file, "r").read())
-        else:
-            self.geb = GfDeployment.from_network(web3=self.web3, network=self.arguments.network)
+        # Contracts are only built once a phase of the keeper uses them
+        self.geb = LazyDeployment.load(web3=self.web3, network=self.arguments.network,
+                                       deployment_file=self.arguments.gf_deployment_file)
 
 
         self.deployment_block = self.arguments.safe_engine_deployment_block
 
+        # Created now, so a directory which can't be written to stops the keeper before settlement
+        if self.arguments.log_checkpoint_dir:
+            os.makedirs(self.arguments.log_checkpoint_dir, exist_ok=True)
+
+        self.status_probe = StatusProbe(self.web3, self.geb.address('global_settlement'))
+
         self.max_errors = self.arguments.max_errors
         self.errors = 0
 
-        self.settlement_facilitated = self.arguments.settlement_facilitated
+        self.journal = SettlementJournal(self.arguments.journal_file)
+        self.attempted = set()
+
+        self.settlement_facilitated = self.arguments.settlement_facilitated or \
+                                      self.journal.state.get('processing_period_complete', False)
+
+        self.confirmations = self.journal.state.get('confirmations', 0)
 
-        self.confirmations = 0
+        self.underwater_indexes = {}
+        self.snapshots = {}
+        self.imported_snapshot = None
+
+        self.first_check = True
 
         # Create gas strategy
         if self.arguments.ethgasstation_api_key:
+            from auction_keeper.gas import DynamicGasPrice
             self.gas_price = DynamicGasPrice(self.arguments, self.web3)
         else:
             self.gas_price = DefaultGasPrice()
@@ -122,6 +209,18 @@ class SettlementKeeper:
         logging.basicConfig(format='%(asctime)-15s %(levelname)-8s %(message)s',
                             level=(logging.DEBUG if self.arguments.debug else logging.INFO))
 
+        self.profiler = None
+        if self.arguments.profile:
+            self.profiler = PhaseProfiler(self.arguments.profile, self.arguments.profile_mode)
+            self.profiler.wrap(self, ['check_settlement', 'facilitate_processing_period', 'set_outstanding_coin_supply',
+                                      'get_collateral_types', 'get_underwater_safes', 'all_active_auctions',
+                                      'send_action', 'export_snapshot', 'load_snapshot_file'])
+
+        self.reconcile_journal()
+
+        if self.arguments.snapshot_file:
+            self.load_snapshot_file(self.arguments.snapshot_file)
+
 
     def main(self):
         """ Initialize the lifecycle and enter into the Keeper Lifecycle controller
@@ -131,22 +230,30 @@ class SettlementKeeper:
         if it recieves a SIGINT/SIGTERM signal.
 
         """
-        with Lifecycle(self.web3) as lifecycle:
-            self.lifecycle = lifecycle
-            lifecycle.on_startup(self.check_deployment)
-            lifecycle.on_block(self.process_block)
+        try:
+            if self.arguments.export_snapshot:
+                self.export_snapshot(self.arguments.export_snapshot)
+                return
+
+            with Lifecycle(self.web3) as lifecycle:
+                self.lifecycle = lifecycle
+                lifecycle.on_startup(self.check_deployment)
+                lifecycle.on_block(self.process_block)
+        finally:
+            if self.profiler is not None:
+                self.profiler.close()
 
 
     def check_deployment(self):
         self.logger.info('')
         self.logger.info('Please confirm the deployment details')
         self.logger.info(f'Keeper Balance: {self.web3.eth.getBalance(self.our_address.address) / (10**18)} ETH')
-        self.logger.info(f'SAFE Engine: {self.geb.safe_engine.address}')
-        self.logger.info(f'Accounting Engine: {self.geb.accounting_engine.address}')
-        self.logger.info(f'PreSettlementSurplusAuctionHouse: {self.geb.surplus_auction_house.address}')
-        self.logger.info(f'Debt Auction House: {self.geb.debt_auction_house.address}')
-        self.logger.info(f'Tax Collector: {self.geb.tax_collector.address}')
-        self.logger.info(f'Global Settlement: {self.geb.global_settlement.address}')
+        self.logger.info(f'SAFE Engine: {self.geb.address("safe_engine")}')
+        self.logger.info(f'Accounting Engine: {self.geb.address("accounting_engine")}')
+        self.logger.info(f'PreSettlementSurplusAuctionHouse: {self.geb.address("surplus_auction_house")}')
+        self.logger.info(f'Debt Auction House: {self.geb.address("debt_auction_house")}')
+        self.logger.info(f'Tax Collector: {self.geb.address("tax_collector")}')
+        self.logger.info(f'Global Settlement: {self.geb.address("global_settlement")}')
         self.logger.info('')
 
 
@@ -155,29 +262,51 @@ class SettlementKeeper:
         if self.errors >= self.max_errors:
             self.lifecycle.terminate()
         else:
+            reset_requests()
             self.check_settlement()
+            self.check_rpc_budget()
+
+    def check_rpc_budget(self):
+        """ Warns if processing the block took more requests than `--rpc-budget`
+
+        Requests are counted on the thread processing the block and the worker threads it hands requests to.
+        Those pyflex's Lifecycle makes on its own threads to watch for new blocks are not, as the counters are
+        per thread and a supervisor shares one watcher among keepers.
+        """
+        requests = requests_made()
+        used = sum(requests.values())
+        self.logger.debug(f'Made {used} requests this block: {dict(requests)}')
+
+        if self.arguments.rpc_budget is not None and used > self.arguments.rpc_budget:
+            self.logger.warning(f'Made {used} requests this block, over the budget of '
+                                f'{self.arguments.rpc_budget}: {dict(requests)}')
 
 
     def check_settlement(self):
         """ After live is 0 for 12 block confirmations, facilitate the processing period, then set_outstanding_coin_supply """
-        block_number = self.web3.eth.blockNumber
+        # Everything needed while the keeper waits is read in a single batched request
+        status = self.status_probe.probe()
+        block_number = status.block_number
         self.logger.info(f'Checking settlement on block {block_number}')
 
-        contract_enabled = self.geb.global_settlement.contract_enabled()
+        if self.first_check:
+            self.first_check = False
+            self.logger.info(f'First settlement check {time.time() - started_at:.2f}s after the keeper started, '
+                             f'{imported_at - started_at:.2f}s of which importing modules')
+
+        contract_enabled = status.contract_enabled
 
         # Ensure 12 blocks confirmations have passed before facilitating settlement
         if not contract_enabled and (self.confirmations == 12):
             self.logger.info('======== System has been settled ========')
 
-            shutdown_time = self.geb.global_settlement.shutdown_time()
-            shutdown_cooldown = self.geb.global_settlement.shutdown_cooldown()
-            shutdown_time_in_unix = shutdown_time.replace(tzinfo=timezone.utc).timestamp()
-            now = self.web3.eth.getBlock(block_number).timestamp
-            set_outstanding_coin_supply_time = shutdown_time_in_unix + shutdown_cooldown 
+            now = status.timestamp
+            set_outstanding_coin_supply_time = status.shutdown_time + status.shutdown_cooldown
 
+            # Only marked facilitated once it completes, so a failed discovery is retried on the next block
             if not self.settlement_facilitated:
-                self.settlement_facilitated = True
                 self.facilitate_processing_period()
+                self.settlement_facilitated = True
 
             # wait until processing time concludes
             elif (now >= set_outstanding_coin_supply_time):
@@ -195,6 +324,7 @@ class SettlementKeeper:
 
         elif not contract_enabled and self.confirmations < 13:
             self.confirmations = self.confirmations + 1
+            self.journal.set('confirmations', self.confirmations)
             self.logger.info(f'======== System has been settled ( {self.confirmations} confirmations) ========')
 
 
@@ -206,30 +336,60 @@ class SettlementKeeper:
         self.logger.info('======== Facilitating Settlement ========')
         self.logger.info('')
 
-        # check collateral_types
-        collateral_types = self.get_collateral_types()
+        # Plan every auction termination, freeze and fast track before sending any, unless a previous run did
+        if not self.journal.state.get('auctions_planned'):
+            snapshot = self.imported_snapshot or self.snapshot(self.web3.eth.blockNumber)
+            collateral_types = snapshot.read('collateral_types', self.get_collateral_types)
+
+            # Get all auctions that can be prematurely terminated after shutdown
+            auction_ids = snapshot.read('auction_ids', self.active_auction_ids)
+
+            for id in auction_ids["surplus_auctions"]:
+                self.journal.plan('terminate_surplus_auction', [id])
+            for id in auction_ids["debt_auctions"]:
+                self.journal.plan('terminate_debt_auction', [id])
+            for collateral_type in collateral_types:
+                self.journal.plan('freeze_collateral_type', [collateral_type.name])
+            for key in auction_ids["collateral_auctions"].keys():
+                for id in auction_ids["collateral_auctions"][key]:
+                    self.journal.plan('fast_track_auction', [key, id])
+
+            self.journal.set('collateral_types', [collateral_type.name for collateral_type in collateral_types])
+            self.journal.set('auctions_planned', True)
+        else:
+            self.logger.info('Resuming the processing period from the settlement journal')
 
-        # Get all auctions that can be prematurely terminated after shutdown
-        auctions = self.all_active_auctions()
+        # Prematurely terminate surplus and debt auctions, freeze all collateral_types, fast track collateral auctions
+        self.send_pending()
 
-        # Prematurely terminate all surplus and debt auctions
-        self.terminate_auctions_prematurely(auctions["surplus_auctions"], auctions["debt_auctions"])
+        # Fast tracked auctions return their debt to safes, so underwater safes are only looked for afterwards
+        if not self.journal.state.get('safes_planned'):
+            collateral_types = self.settlement_collateral_types()
 
-        # Freeze all collateral_types
-        for collateral_type in collateral_types:
-            self.geb.global_settlement.freeze_collateral_type(collateral_type).transact(gas_price=self.gas_price)
+            # A snapshot file taken before any auction was fast tracked still holds every safe's debt. Otherwise
+            # safes are read at the head, as it holds the fast tracks; a Graph node is waited on until it indexes it.
+            fast_tracked = any(action['action'] == 'fast_track_auction' for action in self.journal.actions.values())
+            snapshot = self.imported_snapshot if self.imported_snapshot and not fast_tracked \
+                else self.snapshot(self.web3.eth.blockNumber)
+            underwater_safes = snapshot.read('underwater_safes',
+                                             lambda: self.get_underwater_safes(collateral_types, snapshot.block_number))
 
-        # Fast track all collateral auctions
-        for key in auctions["collateral_auctions"].keys():
-            collateral_type = self.geb.safe_engine.collateral_type(key)
-            for bid in auctions["collateral_auctions"][key]:
-                self.geb.global_settlement.fast_track_auction(collateral_type,bid.id).transact(gas_price=self.gas_price)
+            for safe in underwater_safes:
+                self.journal.plan('process_safe', [safe.collateral_type.name, safe.address.address])
 
-        safes = self.get_underwater_safes(collateral_types)
+            self.journal.set('safes_planned', True)
 
         # Process all underwater safes
-        for i in safes:
-            self.geb.global_settlement.process_safe(i.collateral_type, i.address).transact(gas_price=self.gas_price)
+        self.send_pending()
+
+        # Actions which failed are tried again when the keeper restarts, which goes through the processing period
+        # again until every action has been mined
+        not_mined = self.journal.pending()
+        if not_mined:
+            self.logger.warning(f'{len(not_mined)} settlement actions were not mined, and will be retried when the '
+                                f'keeper restarts: {not_mined}')
+        else:
+            self.journal.set('processing_period_complete', True)
 
     def set_outstanding_coin_supply(self):
         """ Once GlobalSettlement.shutdownCooldown is reached, annihilate any lingering system coin in the Accounting Engine,
@@ -238,22 +398,197 @@ class SettlementKeeper:
         self.logger.info('======== Setting outstanding coin supply ========')
         self.logger.info('')
 
-        collateral_types = self.get_collateral_types()
+        collateral_types = self.settlement_collateral_types()
 
         # check if system coin is in AccountingEngine and annihilate it with settleDebt()
         system_coin = self.geb.safe_engine.coin_balance(self.geb.accounting_engine.address)
         if system_coin > Rad(0):
-            self.geb.accounting_engine.settle_debt(system_coin).transact(gas_price=self.gas_price)
+            self.send('settle_debt', [system_coin.value])
 
         # Fix outstanding supply of System coin
-        self.geb.global_settlement.set_outstanding_coin_supply().transact(gas_price=self.gas_price)
+        self.send('set_outstanding_coin_supply', [])
 
         # Set fix (collateral/system_coin ratio) for all CollateralTypes
         for collateral_type in collateral_types:
-            self.geb.global_settlement.calculate_cash_price(collateral_type).transact(gas_price=self.gas_price)
+            self.send('calculate_cash_price', [collateral_type.name])
+
+    def settlement_transaction(self, action: str, params: list) -> Transact:
+        """ Builds the transaction of a journaled settlement action """
+        from pyflex.gf import CollateralType
+
+        transactions = {
+            'terminate_surplus_auction': lambda id: self.geb.surplus_auction_house.terminate_auction_prematurely(id),
+            'terminate_debt_auction': lambda id: self.geb.debt_auction_house.terminate_auction_prematurely(id),
+            'freeze_collateral_type': lambda name: self.geb.global_settlement.freeze_collateral_type(CollateralType(name)),
+            'fast_track_auction': lambda name, id: self.geb.global_settlement.fast_track_auction(CollateralType(name), id),
+            'process_safe': lambda name, address: self.geb.global_settlement.process_safe(CollateralType(name), Address(address)),
+            'settle_debt': lambda amount: self.geb.accounting_engine.settle_debt(Rad(amount)),
+            'set_outstanding_coin_supply': lambda: self.geb.global_settlement.set_outstanding_coin_supply(),
+            'calculate_cash_price': lambda name: self.geb.global_settlement.calculate_cash_price(CollateralType(name))
+        }
+
+        return transactions[action](*params)
+
+    def send(self, action: str, params: list):
+        """ Journals and sends a settlement action, unless the journal shows it was already mined """
+        key = self.journal.plan(action, params)
+
+        if self.journal.status(key) == SettlementJournal.MINED:
+            self.logger.info(f'Skipping {key}, which was already mined')
+        else:
+            self.send_action(key)
+
+    def send_pending(self):
+        """ Sends every journaled action not yet mined, trying each at most once per run """
+        for key in self.journal.pending():
+            if key not in self.attempted:
+                self.send_action(key)
+
+    def send_action(self, key: str):
+        action = self.journal.actions[key]
+        transact = self.settlement_transaction(action['action'], action['params'])
+        self.attempted.add(key)
+
+        # pyflex's Transact keeps every hash it sends, replacements included, in `tx_hashes`
+        if self.journal.path is not None and not hasattr(transact, 'tx_hashes'):
+            raise RuntimeError(f'This pyflex version does not record the hashes of the transactions it sends, '
+                               f'so {key} could not be journaled as sent')
+
+        # Journal transaction hashes as they are sent rather than once mined, so a restart can look them up
+        loop = asyncio.get_event_loop()
+        task = loop.create_task(transact.transact_async(gas_price=self.gas_price))
+        journaled = 0
+        while not task.done():
+            loop.run_until_complete(asyncio.wait([task], timeout=1))
+
+            tx_hashes = getattr(transact, 'tx_hashes', [])
+            for tx_hash in tx_hashes[journaled:]:
+                self.journal.sent(key, self._hex(tx_hash))
+            journaled = len(tx_hashes)
+
+        receipt = task.result()
+        if receipt is not None:
+            self.journal.mined(key, self._hex(receipt.transaction_hash))
+        else:
+            self.journal.failed(key)
+
+    def reconcile_journal(self):
+        """ Marks actions a previous run sent, but didn't see mined, according to their receipts """
+        for key in self.journal.pending():
+            for tx_hash in self.journal.actions[key]['tx_hashes']:
+                try:
+                    receipt = self.web3.eth.getTransactionReceipt(tx_hash)
+                except TransactionNotFound:
+                    continue
+
+                if receipt.status == 1:
+                    self.logger.info(f'{key} was mined in {tx_hash} before the keeper restarted')
+                    self.journal.mined(key, tx_hash)
+                    break
+
+    @staticmethod
+    def _hex(tx_hash) -> str:
+        return tx_hash if isinstance(tx_hash, str) else Web3.toHex(tx_hash)
+
+
+    def snapshot(self, block_number: int) -> SettlementSnapshot:
+        """ Returns the snapshot of a block, reusing the one already taken unless a reorg replaced the block """
+        snapshot = self.snapshots.get(block_number)
+        if snapshot is None or not snapshot.is_canonical():
+            snapshot = SettlementSnapshot(self.web3, block_number)
+            self.snapshots[block_number] = snapshot
+            self.logger.info(f'Reading settlement state at block {block_number}')
+
+        return snapshot
+
+    def export_snapshot(self, path: str):
+        """ Writes the collateral types, safes and active auctions of the latest block to a snapshot file """
+        from src.snapshot_file import SnapshotFile
+
+        block_number = self.web3.eth.blockNumber
+        if self.arguments.graph_endpoint:
+            # The Graph node trails the chain, so the snapshot is taken at the last block it has indexed
+            from src.graph_safe_history import GraphSAFEHistory
+            block_number = min(block_number, GraphSAFEHistory.indexed_block(self.arguments.graph_endpoint))
+
+        snapshot = self.snapshot(block_number)
+        collateral_types = snapshot.read('collateral_types', self.get_collateral_types)
+        auction_ids = snapshot.read('auction_ids', self.active_auction_ids)
+        snapshot.read('underwater_safes', lambda: self.get_underwater_safes(collateral_types, snapshot.block_number))
+        safety_c_ratios = snapshot.read('safety_c_ratios', lambda: {
+            collateral_type.name: self.geb.oracle_relayer.safety_c_ratio(collateral_type)
+            for collateral_type in collateral_types})
+
+        # The indexes hold every safe with debt, and the collateral type parameters read at the snapshot block
+        indexes = [self.underwater_indexes[collateral_type.name] for collateral_type in collateral_types]
+        SnapshotFile.write(path, snapshot.block_number, Web3.toHex(snapshot.block_hash),
+                           [(index.collateral_type, safety_c_ratios[index.collateral_type.name], index.safes())
+                            for index in indexes],
+                           auction_ids)
+
+        self.logger.info(f'Wrote the settlement state of block {snapshot.block_number} to {path}')
+
+    def load_snapshot_file(self, path: str):
+        """ Uses the settlement state of a snapshot file, if its block is canonical and after shutdown """
+        from src.snapshot_file import SnapshotFile
+
+        started = time.time()
+        try:
+            snapshot_file = SnapshotFile(path)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f'Ignoring {path}, settlement state will be read from the chain: {e}')
+            return
+
+        try:
+            block = self.web3.eth.getBlock(snapshot_file.block_number)
+        except BlockNotFound:
+            block = None
+        if block is None or bytes(block.hash) != snapshot_file.block_hash:
+            self.logger.warning(f'Ignoring {path}, block {snapshot_file.block_number} is no longer canonical')
+            snapshot_file.close()
+            return
+
+        # State at the snapshot block may be pruned by now, so shutdown is read at the head and compared in time
+        shutdown_time = self.status_probe.probe().shutdown_time
+        if shutdown_time == 0 or block.timestamp < shutdown_time:
+            self.logger.warning(f'Ignoring {path}, it was taken before shutdown')
+            snapshot_file.close()
+            return
+
+        snapshot = SettlementSnapshot(self.web3, snapshot_file.block_number, snapshot_file.block_hash)
+        names = snapshot_file.collateral_type_names
+        snapshot.provide('collateral_types', lambda: [snapshot_file.collateral_type(name) for name in names])
+        snapshot.provide('auction_ids', lambda: snapshot_file.auction_ids)
+        snapshot.provide('underwater_safes', lambda: self.snapshot_underwater_safes(snapshot_file))
+
+        self.snapshots[snapshot.block_number] = snapshot
+        self.imported_snapshot = snapshot
+        self.logger.info(f'Loaded the settlement state of block {snapshot.block_number} from {path} '
+                         f'in {time.time() - started:.2f}s')
+
+    def snapshot_underwater_safes(self, snapshot_file: 'SnapshotFile') -> List['SAFE']:
+        from src.underwater_index import UnderwaterIndex
+
+        underwater_safes = []
+        for name in snapshot_file.collateral_type_names:
+            collateral_type = snapshot_file.collateral_type(name)
+
+            index = UnderwaterIndex.from_safes(collateral_type, snapshot_file.safes(name))
+            self.underwater_indexes[name] = index
 
+            underwater_safes.extend(index.underwater(collateral_type.accumulated_rate, collateral_type.safety_price,
+                                                     snapshot_file.safety_c_ratio(name)))
 
-    def get_collateral_types(self) -> List[CollateralType]:
+        return underwater_safes
+
+    def settlement_collateral_types(self) -> List['CollateralType']:
+        """ The collateral types frozen by the processing period, or those with debt if it hasn't been planned """
+        if 'collateral_types' not in self.journal.state:
+            return self.get_collateral_types()
+
+        return [self.geb.collaterals[name].collateral_type for name in self.journal.state['collateral_types']]
+
+    def get_collateral_types(self) -> List['CollateralType']:
         """ Use CollateralTypes as saved in https://github.com/makerdao/pyflex/tree/master/config """
 
         collateral_types = [self.geb.collaterals[key].collateral_type for key in self.geb.collaterals.keys()]
@@ -266,39 +601,61 @@ class SettlementKeeper:
         return collateral_types_with_debt
 
 
-    def get_underwater_safes(self, collateral_types: List) -> List[SAFE]:
-        """ With all safes every frobbed, compile and return a list safes that are under-collateralized up to 100%  """
+    def get_underwater_safes(self, collateral_types: List, block_number: Optional[int] = None) -> List['SAFE']:
+        """ With all safes every frobbed, compile and return a list safes that are under-collateralized up to 100%
+
+            With a `block_number`, safes are discovered as of that block, which should be the block any other
+            reads are pinned to.
+        """
+        from src.graph_safe_history import GraphSAFEHistory
+        from src.safe_log_history import SAFELogHistory
+        from src.underwater_index import UnderwaterIndex
 
         underwater_safes = []
-        
+
         self.logger.info(f'Getting underwater safes for {collateral_types}')
         for collateral_type in collateral_types:
 
-            safe_history = SAFEHistory(self.web3, self.geb, collateral_type, self.deployment_block, self.arguments.graph_endpoint)
+            if self.arguments.graph_endpoint:
+                safe_history = GraphSAFEHistory(self.arguments.graph_endpoint, collateral_type,
+                                                page_size=self.arguments.graph_page_size,
+                                                max_workers=self.arguments.max_workers,
+                                                block_number=block_number)
+            else:
+                safe_history = SAFELogHistory(self.web3, self.geb, collateral_type, self.deployment_block,
+                                              self.log_indexer(f'{collateral_type.name}-safes.json'),
+                                              to_block=block_number)
 
             safes = safe_history.get_safes()
 
             self.logger.info(f'Collected {len(safes)} safes from {collateral_type}')
 
-            for i, safe in enumerate(safes.values()):
-                safe.collateral_type = self.geb.safe_engine.collateral_type(safe.collateral_type.name)
-                safety_ratio = self.geb.oracle_relayer.safety_c_ratio(safe.collateral_type)
+            # accumulated_rate, safety_price and safety_c_ratio are shared by every safe of the collateral type
+            collateral_type = self.geb.safe_engine.collateral_type(collateral_type.name)
+            safety_ratio = self.geb.oracle_relayer.safety_c_ratio(collateral_type)
 
-                debt = Ray(safe.generated_debt) * safe.collateral_type.accumulated_rate
-                collateral = Ray(safe.locked_collateral) * safe.collateral_type.safety_price * safety_ratio
+            for safe in safes.values():
+                safe.collateral_type = collateral_type
+            index = UnderwaterIndex.from_safes(collateral_type, safes.values())
 
-                # Check if underwater ->  
-                # safe.generated_debt * collateral_type.accumulated_rate > 
-                # safe.locked_collateral * collateral_type.safety_price * oracle_relayer.safety_c_ratio[collateral_type]
-                if debt > collateral:
-                    underwater_safes.append(safe)
+            self.underwater_indexes[collateral_type.name] = index
 
-                if i % 100 == 0:
-                    self.logger.info(f'Processed {i} safes of {collateral_type.name}')
+            underwater = index.underwater(collateral_type.accumulated_rate, collateral_type.safety_price, safety_ratio)
+            self.logger.info(f'Found {len(underwater)} underwater safes out of {len(index)} safes with debt of {collateral_type.name}')
+            underwater_safes.extend(underwater)
 
         self.logger.info(f'Found {len(underwater_safes)} underwater safes for all collateral-types')
         return underwater_safes
 
+    def log_indexer(self, checkpoint_name: str) -> LogIndexer:
+        checkpoint_file = os.path.join(self.arguments.log_checkpoint_dir, checkpoint_name) \
+            if self.arguments.log_checkpoint_dir else None
+
+        return LogIndexer(raw_get_logs(self.web3),
+                          chunk_size=self.arguments.log_chunk_size,
+                          max_workers=self.arguments.max_workers,
+                          checkpoint_file=checkpoint_file)
+
     def all_active_auctions(self) -> dict:
         """ Aggregates active auctions that meet criteria to be called after Settlement """
         collateral_auctions = {}
@@ -313,11 +670,23 @@ class SettlementKeeper:
         }
 
 
+    def active_auction_ids(self) -> dict:
+        """ Ids of the auctions returned by `all_active_auctions` """
+        auctions = self.all_active_auctions()
+
+        return {
+            "collateral_auctions": {name: [bid.id for bid in bids] for name, bids in auctions["collateral_auctions"].items()},
+            "surplus_auctions": [bid.id for bid in auctions["surplus_auctions"]],
+            "debt_auctions": [bid.id for bid in auctions["debt_auctions"]]
+        }
+
     def settlement_active_auctions(self, parent_obj) -> List:
         """ Returns auctions that meet the requiremenets to be called by
             GlobalSettlement.fastTrackAuction, SurplusAuctionHouse.terminateAuctionPrematurely and 
             DebtAuctionHouse.terminateAuctionPrematurely
         """
+        from pyflex.auctions import FixedDiscountCollateralAuctionHouse, EnglishCollateralAuctionHouse
+
         active_auctions = []
         auction_count = parent_obj.auctions_started()
 
@@ -345,15 +714,5 @@ class SettlementKeeper:
 
         return active_auctions
 
-    def terminate_auctions_prematurely(self, surplus_bids: List, debt_bids: List):
-        """ Calls terminate_auction_prematurely on all PreSettlementSurplusAuctionHouse and DebtAuctionHouse 
-            auctions ids that meet the shutdown criteria 
-        """
-        for bid in surplus_bids:
-            self.geb.surplus_auction_house.terminate_auction_prematurely(bid.id).transact(gas_price=self.gas_price)
-
-        for bid in debt_bids:
-            self.geb.debt_auction_house.terminate_auction_prematurely(bid.id).transact(gas_price=self.gas_price)
-
 if __name__ == '__main__':
     SettlementKeeper(sys.argv[1:]).main()
@@ -0,0 +1,65 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from typing import Callable, Optional
+
+from web3 import Web3
+
+from src.rpc import pinned_to
+
+
+class SettlementSnapshot:
+    """ Settlement discovery results, every one of them read at the same block
+
+    Since state at a block never changes, each result is read once and kept for as long as the snapshot is.
+    A reorg is the only thing which invalidates a snapshot, which `is_canonical` checks with a single block lookup.
+    """
+
+    logger = logging.getLogger('settlement-snapshot')
+
+    def __init__(self, web3: Web3, block_number: int, block_hash: Optional[bytes] = None):
+        assert isinstance(web3, Web3)
+        assert isinstance(block_number, int)
+        assert isinstance(block_hash, bytes) or block_hash is None
+
+        self.web3 = web3
+        self.block_number = block_number
+        self.block_hash = block_hash if block_hash is not None else web3.eth.getBlock(block_number).hash
+        self._results = {}
+        self._sources = {}
+
+    def provide(self, name: str, function: Callable):
+        """ Makes `read` take the result from `function` rather than the chain, such as from a snapshot file """
+        self._sources[name] = function
+
+    def read(self, name: str, function: Callable):
+        """ Returns the result of `function` with its state reads pinned to the snapshot block, reading it once """
+        if name not in self._results:
+            with pinned_to(self.block_number):
+                self._results[name] = self._sources.get(name, function)()
+
+        return self._results[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._results
+
+    def is_canonical(self) -> bool:
+        return self.web3.eth.getBlock(self.block_number).hash == self.block_hash
+
+    def __repr__(self):
+        return f"SettlementSnapshot({self.block_number}, {Web3.toHex(self.block_hash)})"
@@ -0,0 +1,191 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import json
+import mmap
+import os
+import struct
+import zlib
+from typing import Iterator, List, Tuple
+
+from pyflex import Address
+from pyflex.gf import CollateralType, SAFE
+from pyflex.numeric import Wad, Ray
+
+
+class SnapshotFile:
+    """ Settlement discovery results of one block, in a file other keepers can map instead of reading the chain
+
+    The file starts with a fixed header (magic, format version and metadata length), followed by JSON metadata
+    holding the block, the parameters of each collateral type and the active auction ids. The SAFEs of each
+    collateral type follow as columns: 20 byte addresses, then locked collateral and generated debt as 32 byte
+    big-endian integers, each column aligned to 8 bytes. Columns are read straight from the mapped file.
+
+    The metadata holds a CRC-32 of the columns, so a file truncated or corrupted on its way between nodes is
+    refused when opened rather than read as SAFEs without debt.
+    """
+
+    MAGIC = b'GEBSNAP\x00'
+    VERSION = 2
+    HEADER = struct.Struct('<8sII')
+
+    ADDRESS_SIZE = 20
+    AMOUNT_SIZE = 32
+    COLUMNS = ['address', 'locked_collateral', 'generated_debt']
+
+    def __init__(self, path: str):
+        assert isinstance(path, str)
+
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < self.HEADER.size:
+                raise ValueError(f'{path} is too short to be a settlement snapshot')
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self._data = None
+
+        try:
+            self._open()
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self):
+        magic, version, metadata_length = self.HEADER.unpack_from(self._view)
+        if magic != self.MAGIC:
+            raise ValueError(f'{self.path} is not a settlement snapshot')
+        if version != self.VERSION:
+            raise ValueError(f'{self.path} has snapshot format version {version}, expected {self.VERSION}')
+
+        metadata_start = self.HEADER.size
+        if metadata_start + metadata_length > len(self._view):
+            raise ValueError(f'{self.path} is truncated, its metadata is incomplete')
+        self.metadata = json.loads(bytes(self._view[metadata_start:metadata_start + metadata_length]).decode('utf-8'))
+        self._data = self._view[self._align(metadata_start + metadata_length):]
+
+        for name, params in self.metadata['collateral_types'].items():
+            for column in self.COLUMNS:
+                size = self.ADDRESS_SIZE if column == 'address' else self.AMOUNT_SIZE
+                if params['columns'][column] + params['safes'] * size > len(self._data):
+                    raise ValueError(f'{self.path} is truncated, the {column} column of {name} is incomplete')
+        if zlib.crc32(self._data) != self.metadata['checksum']:
+            raise ValueError(f'{self.path} is corrupt, its checksum does not match')
+
+        self.block_number = self.metadata['block_number']
+        self.block_hash = bytes.fromhex(self.metadata['block_hash'][2:])
+        self.auction_ids = self.metadata['auction_ids']
+
+    @staticmethod
+    def _align(offset: int) -> int:
+        return (offset + 7) // 8 * 8
+
+    @staticmethod
+    def write(path: str, block_number: int, block_hash: str,
+              collateral_types: List[Tuple[CollateralType, Ray, List[SAFE]]], auction_ids: dict):
+        """ Writes a snapshot from each collateral type with its safety_c_ratio and SAFEs, replacing `path` at once """
+        assert isinstance(block_number, int)
+        assert isinstance(block_hash, str)
+        assert isinstance(auction_ids, dict)
+
+        columns = []
+        offset = 0
+        metadata = {'block_number': block_number, 'block_hash': block_hash, 'auction_ids': auction_ids,
+                    'collateral_types': {}}
+
+        for collateral_type, safety_c_ratio, safes in collateral_types:
+            data = [b''.join(bytes.fromhex(safe.address.address[2:]) for safe in safes),
+                    b''.join(safe.locked_collateral.value.to_bytes(SnapshotFile.AMOUNT_SIZE, 'big') for safe in safes),
+                    b''.join(safe.generated_debt.value.to_bytes(SnapshotFile.AMOUNT_SIZE, 'big') for safe in safes)]
+
+            offsets = {}
+            for name, column in zip(SnapshotFile.COLUMNS, data):
+                offsets[name] = offset
+                padded = column + bytes(SnapshotFile._align(len(column)) - len(column))
+                columns.append(padded)
+                offset += len(padded)
+
+            metadata['collateral_types'][collateral_type.name] = {
+                'accumulated_rate': collateral_type.accumulated_rate.value,
+                'safety_price': collateral_type.safety_price.value,
+                'safe_debt': collateral_type.safe_debt.value,
+                'safety_c_ratio': safety_c_ratio.value,
+                'safes': len(safes),
+                'columns': offsets
+            }
+
+        metadata['checksum'] = functools.reduce(lambda crc, column: zlib.crc32(column, crc), columns, 0)
+
+        encoded = json.dumps(metadata).encode('utf-8')
+        header = SnapshotFile.HEADER.pack(SnapshotFile.MAGIC, SnapshotFile.VERSION, len(encoded)) + encoded
+        header += bytes(SnapshotFile._align(len(header)) - len(header))
+
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(header)
+            for column in columns:
+                f.write(column)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+
+    @property
+    def collateral_type_names(self) -> List[str]:
+        return list(self.metadata['collateral_types'].keys())
+
+    def collateral_type(self, name: str) -> CollateralType:
+        """ The collateral type with the parameters it had at the snapshot block """
+        params = self.metadata['collateral_types'][name]
+
+        collateral_type = CollateralType(name)
+        collateral_type.accumulated_rate = Ray(params['accumulated_rate'])
+        collateral_type.safety_price = Ray(params['safety_price'])
+        collateral_type.safe_debt = Wad(params['safe_debt'])
+
+        return collateral_type
+
+    def safety_c_ratio(self, name: str) -> Ray:
+        return Ray(self.metadata['collateral_types'][name]['safety_c_ratio'])
+
+    def column(self, name: str, column: str) -> memoryview:
+        """ A column of the SAFEs of a collateral type, without copying it out of the file """
+        assert column in self.COLUMNS
+
+        params = self.metadata['collateral_types'][name]
+        size = self.ADDRESS_SIZE if column == 'address' else self.AMOUNT_SIZE
+        start = params['columns'][column]
+
+        return self._data[start:start + params['safes'] * size]
+
+    def safes(self, name: str) -> Iterator[SAFE]:
+        """ Decodes the SAFEs of a collateral type, in the order they were written """
+        collateral_type = self.collateral_type(name)
+        addresses = self.column(name, 'address')
+        locked_collateral = self.column(name, 'locked_collateral')
+        generated_debt = self.column(name, 'generated_debt')
+
+        for i in range(self.metadata['collateral_types'][name]['safes']):
+            amount = slice(i * self.AMOUNT_SIZE, (i + 1) * self.AMOUNT_SIZE)
+            yield SAFE(Address('0x' + addresses[i * self.ADDRESS_SIZE:(i + 1) * self.ADDRESS_SIZE].hex()),
+                       collateral_type,
+                       Wad(int.from_bytes(locked_collateral[amount], 'big')),
+                       Wad(int.from_bytes(generated_debt[amount], 'big')))
+
+    def close(self):
+        if self._data is not None:
+            self._data.release()
+        self._view.release()
+        self._map.close()
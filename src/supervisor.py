@@ -0,0 +1,198 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from web3 import Web3, HTTPProvider
+
+from src.settlement_keeper import SettlementKeeper
+
+
+class DeploymentLifecycle:
+    """ Takes the place of a keeper's Lifecycle, so `terminate()` only stops that one deployment """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.terminated = False
+
+    def terminate(self, message=None):
+        if not self.terminated:
+            SettlementSupervisor.logger.warning(f'Terminating {self.name}' + (f': {message}' if message else ''))
+        self.terminated = True
+
+
+class SupervisedKeeper:
+    def __init__(self, name: str, keeper: SettlementKeeper):
+        self.name = name
+        self.keeper = keeper
+        self.lifecycle = DeploymentLifecycle(name)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.busy = None
+
+        keeper.lifecycle = self.lifecycle
+
+
+class SettlementSupervisor:
+    """ Runs the settlement keepers of several deployments in one process
+
+    Keepers sharing a JSON-RPC endpoint share one block poll and one connection pool, and keepers which also share
+    an account share one Web3 instance. Each keeper handles its blocks on its own thread, one block at a time, and
+    an error in one deployment only counts towards that keeper's `--max-errors`.
+    """
+
+    logger = logging.getLogger('settlement-supervisor')
+
+    # Options naming files or directories a keeper writes to, which deployments can't share
+    OWN_PATHS = ['--journal-file', '--log-checkpoint-dir', '--profile']
+
+    def __init__(self, args: list):
+        parser = argparse.ArgumentParser("settlement-supervisor")
+
+        parser.add_argument("--config", type=str, required=True,
+                            help="Json file listing the deployments to supervise, each with a `name` and the "
+                                 "settlement-keeper `args` to run it with")
+
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds between polls for new blocks on each JSON-RPC endpoint (default: 1)")
+
+        parser.add_argument("--debug", dest='debug', action='store_true',
+                            help="Enable debug output")
+
+        self.arguments = parser.parse_args(args)
+
+        # Configured ahead of the keepers, so every record names the deployment thread it came from
+        logging.basicConfig(format='%(asctime)-15s %(levelname)-8s [%(threadName)s] %(message)s',
+                            level=(logging.DEBUG if self.arguments.debug else logging.INFO))
+
+        with open(self.arguments.config, 'r') as f:
+            deployments = json.load(f)['deployments']
+
+        self.web3s: Dict[tuple, Web3] = {}
+        self.endpoints: Dict[str, List[SupervisedKeeper]] = {}
+        self.paths: Dict[str, str] = {}
+        for deployment in deployments:
+            keeper_args = deployment['args'].split() if isinstance(deployment['args'], str) else deployment['args']
+            self.add(deployment['name'], SettlementKeeper(keeper_args, web3=self.web3(keeper_args)))
+
+        self.logger.info(f'Supervising {len(deployments)} deployments on {len(self.endpoints)} JSON-RPC endpoints')
+
+    def add(self, name: str, keeper: SettlementKeeper):
+        # Supervised keepers never run `main()`, so a one-off export would silently never happen
+        if keeper.arguments.export_snapshot:
+            raise ValueError(f'{name}: --export-snapshot runs once and exits, so it can\'t be supervised; '
+                             f'run settlement-keeper with it instead')
+
+        # Journals, checkpoints and profiles use fixed names, so deployments sharing a path overwrite each other
+        paths = {}
+        for option in self.OWN_PATHS:
+            path = getattr(keeper.arguments, option.lstrip('-').replace('-', '_'))
+            if path:
+                path = os.path.realpath(path)
+                if path in self.paths or path in paths:
+                    raise ValueError(f'{name}: {option} {path} is already used by '
+                                     f'{self.paths.get(path) or paths.get(path)}')
+                paths[path] = f'{name} {option}'
+        self.paths.update(paths)
+
+        self.endpoints.setdefault(keeper.arguments.rpc_uri, []).append(SupervisedKeeper(name, keeper))
+
+    def web3(self, keeper_args: list) -> Web3:
+        """ Returns the Web3 instance shared by keepers with the same endpoint and account """
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument("--rpc-uri", type=str, default="http://localhost:8545")
+        parser.add_argument("--rpc-timeout", type=int, default=1200)
+        parser.add_argument("--eth-from", type=str, required=True)
+        arguments, _ = parser.parse_known_args(keeper_args)
+
+        key = (arguments.rpc_uri, arguments.eth_from.lower())
+        if key not in self.web3s:
+            # Requests to an endpoint all go through the session web3 caches for its URI
+            self.web3s[key] = Web3(HTTPProvider(endpoint_uri=arguments.rpc_uri,
+                                                request_kwargs={"timeout": arguments.rpc_timeout}))
+
+        return self.web3s[key]
+
+    def main(self):
+        loop = asyncio.get_event_loop()
+        watchers = asyncio.gather(*[self.watch(keepers) for keepers in self.endpoints.values()])
+
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, watchers.cancel)
+
+        try:
+            loop.run_until_complete(watchers)
+        except asyncio.CancelledError:
+            self.logger.info('Shutting down')
+        finally:
+            for keepers in self.endpoints.values():
+                for supervised in keepers:
+                    supervised.executor.shutdown(wait=True)
+                    if supervised.keeper.profiler is not None:
+                        supervised.keeper.profiler.close()
+
+    async def watch(self, keepers: List[SupervisedKeeper]):
+        """ Polls one endpoint for new blocks and hands each block to every live keeper using that endpoint """
+        loop = asyncio.get_event_loop()
+        web3 = keepers[0].keeper.web3
+
+        for supervised in keepers:
+            await loop.run_in_executor(supervised.executor, self.run, supervised, supervised.keeper.check_deployment)
+
+        last_block = None
+        while any(not supervised.lifecycle.terminated for supervised in keepers):
+            try:
+                block_number = await loop.run_in_executor(None, lambda: web3.eth.blockNumber)
+            except Exception as e:
+                self.logger.warning(f'Failed to poll {web3.provider.endpoint_uri} for new blocks: {e}')
+                block_number = last_block
+
+            if block_number != last_block:
+                last_block = block_number
+                for supervised in keepers:
+                    # Like Lifecycle, skip a block if the keeper is still busy with an earlier one
+                    if supervised.lifecycle.terminated or (supervised.busy and not supervised.busy.done()):
+                        continue
+                    supervised.busy = loop.run_in_executor(supervised.executor, self.run, supervised,
+                                                           supervised.keeper.process_block)
+
+            await asyncio.sleep(self.arguments.poll_interval)
+
+    def run(self, supervised: SupervisedKeeper, callback):
+        # pyflex runs transactions on the event loop of the calling thread
+        try:
+            asyncio.get_event_loop()
+        except RuntimeError:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+
+        try:
+            callback()
+        except Exception as e:
+            supervised.keeper.errors += 1
+            self.logger.exception(f'{supervised.name} failed ({supervised.keeper.errors} of '
+                                  f'{supervised.keeper.max_errors} errors allowed): {e}')
+
+
+if __name__ == '__main__':
+    SettlementSupervisor(sys.argv[1:]).main()
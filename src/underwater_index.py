@@ -0,0 +1,126 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left, insort
+from fractions import Fraction
+from typing import Dict, Iterable, List, Optional
+
+from pyflex import Address
+from pyflex.numeric import Ray
+from pyflex.gf import CollateralType, SAFE
+
+
+class UnderwaterIndex:
+    """ Index of the SAFEs of one collateral type, ordered by locked_collateral / generated_debt
+
+    A SAFE is underwater when
+        safe.generated_debt * collateral_type.accumulated_rate >
+        safe.locked_collateral * collateral_type.safety_price * oracle_relayer.safety_c_ratio[collateral_type]
+    which, for a SAFE with debt, is the same as its collateral-to-debt ratio being below
+        accumulated_rate / (safety_price * safety_c_ratio)
+    The right hand side is shared by every SAFE of the collateral type, so the underwater SAFEs are a prefix
+    of the index and can be found with a binary search at any price.
+    """
+
+    def __init__(self, collateral_type: CollateralType):
+        assert isinstance(collateral_type, CollateralType)
+
+        self.collateral_type = collateral_type
+        self._keys = []
+        self._safes: Dict[str, SAFE] = {}
+        self._ratios: Dict[str, Fraction] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, address: Address) -> bool:
+        return address.address.lower() in self._safes
+
+    @staticmethod
+    def from_safes(collateral_type: CollateralType, safes: Iterable[SAFE]) -> 'UnderwaterIndex':
+        """ Indexes SAFEs in one sort, rather than one insertion each; SAFEs without debt are left out """
+        index = UnderwaterIndex(collateral_type)
+        for safe in safes:
+            assert isinstance(safe, SAFE)
+            if safe.generated_debt.value > 0:
+                address = safe.address.address.lower()
+                index._safes[address] = safe
+                index._ratios[address] = Fraction(safe.locked_collateral.value, safe.generated_debt.value)
+
+        index._keys = sorted((ratio, address) for address, ratio in index._ratios.items())
+        return index
+
+    def update(self, safe: SAFE):
+        """ Insert or reposition a SAFE after it has been modified; SAFEs without debt are dropped
+
+        Finding the position takes O(log n), but inserting into the list moves the keys after it, so an update is
+        O(n). That suits the odd modification; `from_safes` builds an index from many SAFEs.
+        """
+        assert isinstance(safe, SAFE)
+
+        self.remove(safe.address)
+
+        if safe.generated_debt.value <= 0:
+            return
+
+        address = safe.address.address.lower()
+        ratio = Fraction(safe.locked_collateral.value, safe.generated_debt.value)
+        insort(self._keys, (ratio, address))
+        self._safes[address] = safe
+        self._ratios[address] = ratio
+
+    def remove(self, address: Address):
+        assert isinstance(address, Address)
+
+        address = address.address.lower()
+        ratio = self._ratios.pop(address, None)
+        if ratio is None:
+            return
+
+        del self._safes[address]
+        del self._keys[bisect_left(self._keys, (ratio, address))]
+
+    @staticmethod
+    def threshold(accumulated_rate: Ray, safety_price: Ray, safety_c_ratio: Ray) -> Optional[Fraction]:
+        """ Collateral-to-debt ratio below which a SAFE is underwater, or `None` if every SAFE with debt is """
+        assert isinstance(accumulated_rate, Ray)
+        assert isinstance(safety_price, Ray)
+        assert isinstance(safety_c_ratio, Ray)
+
+        denominator = safety_price.value * safety_c_ratio.value
+        if denominator == 0:
+            return None
+
+        return Fraction(accumulated_rate.value * Ray.from_number(1).value, denominator)
+
+    def count_underwater(self, accumulated_rate: Ray, safety_price: Ray, safety_c_ratio: Ray) -> int:
+        threshold = self.threshold(accumulated_rate, safety_price, safety_c_ratio)
+        if threshold is None:
+            return len(self._keys)
+
+        # Every key with this ratio compares greater than the bare tuple, so this is a strict comparison
+        return bisect_left(self._keys, (threshold,))
+
+    def underwater(self, accumulated_rate: Ray, safety_price: Ray, safety_c_ratio: Ray) -> List[SAFE]:
+        """ Returns the SAFEs which are underwater at the given rate and prices, lowest ratio first """
+        count = self.count_underwater(accumulated_rate, safety_price, safety_c_ratio)
+
+        return [self._safes[address] for _, address in self._keys[:count]]
+
+    def safes(self) -> List[SAFE]:
+        """ Returns every indexed SAFE, lowest ratio first """
+        return [self._safes[address] for _, address in self._keys]
@@ -35,6 +35,14 @@ run_test () {
 
 }
 
+# Unit tests, which need no testchain
+run_unit_tests () {
+  export PYTHONPATH=$PYTHONPATH:./lib/pyflex:./lib/auction-keeper:./lib/pygasprice-client
+  py.test --cov=src --cov-report=term --cov-append tests --ignore=tests/test_settlement_keeper.py
+}
+
+run_unit_tests
+UNIT_RESULT=$?
 
 # If passing a single config or test file, just run tests on one testchain
 while getopts :c:f: option
@@ -48,10 +56,10 @@ done
 if [ ! -z ${TESTCHAIN} ];then
   echo "Testing on testchain ${TESTCHAIN}"
   run_test $TESTCHAIN
-  exit $?
+  exit $(($UNIT_RESULT + $?))
 fi
 
-COMBINED_RESULT=0
+COMBINED_RESULT=$UNIT_RESULT
 for config in "${TESTCHAINS[@]}"
 do
   run_test $config
@@ -0,0 +1,72 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Measures SAFE log decoding throughput on logs recorded from eth_getLogs, against web3's event decoding
+
+    python -m tests.benchmark_safe_log_decoder --abi SAFEEngine.abi --logs logs.json
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.events import get_event_data
+
+from src.safe_log_decoder import SAFELogDecoder
+
+
+def generic_decoding_seconds(abi: list, logs: list) -> float:
+    """ Time web3 takes to format and decode the same logs, one event object each """
+    codec = Web3().codec
+    events = {Web3.keccak(text=f"{entry['name']}({','.join(i['type'] for i in entry['inputs'])})"): entry
+              for entry in abi if entry.get('type') == 'event'}
+
+    started = time.perf_counter()
+    for log in logs:
+        topics = [HexBytes(topic) for topic in log['topics']]
+        if topics[0] in events:
+            get_event_data(codec, events[topics[0]], dict(log, topics=topics))
+
+    return time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("benchmark-safe-log-decoder",
+                                     description="Measures decoding throughput on logs recorded from eth_getLogs")
+    parser.add_argument("--abi", type=str, required=True, help="SAFEEngine ABI file")
+    parser.add_argument("--logs", type=str, required=True, help="JSON file holding the `result` of eth_getLogs")
+    arguments = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(format='%(asctime)-15s %(levelname)-8s %(message)s', level=logging.INFO)
+    logger = logging.getLogger('benchmark-safe-log-decoder')
+
+    with open(arguments.abi, 'r') as f:
+        safe_engine_abi = json.load(f)
+    with open(arguments.logs, 'r') as f:
+        recorded_logs = json.load(f)
+
+    decoder = SAFELogDecoder(safe_engine_abi)
+    decoder.consume(recorded_logs)
+    logger.info(f'Decoded {decoder.decoded} logs into {len(decoder.totals)} safes '
+                f'in {decoder.elapsed:.3f}s ({decoder.logs_per_second:.0f} logs/s)')
+
+    generic = generic_decoding_seconds(safe_engine_abi, recorded_logs)
+    logger.info(f'web3 event decoding took {generic:.3f}s ({len(recorded_logs) / generic:.0f} logs/s)')
@@ -0,0 +1,170 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import random
+import threading
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from pyflex import Address
+from pyflex.gf import CollateralType
+from pyflex.numeric import Wad
+
+from src.graph_safe_history import GraphSAFEHistory
+from src.rpc import requests_made, reset_requests
+
+
+class GraphStandIn(ThreadingMixIn, HTTPServer):
+    """ Answers the keeper's safes query from memory, the way a Graph node would """
+
+    daemon_threads = True
+
+    def __init__(self, safes: list):
+        super().__init__(('127.0.0.1', 0), GraphRequestHandler)
+        self.safes = sorted(safes, key=lambda safe: safe['id'])
+        self.queries = []
+        self.indexed_block = 1000
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/subgraphs/name/geb'
+
+    def answer(self, query: str, variables: dict) -> dict:
+        with self.lock:
+            self.queries.append((query, variables))
+
+        if '_meta' in query:
+            return {'data': {'_meta': {'block': {'number': self.indexed_block}}}}
+
+        if 'debt_gt: 0' not in query or variables['first'] > 1000:
+            return {'errors': [{'message': 'unexpected query'}]}
+
+        if variables.get('block', 0) > self.indexed_block:
+            return {'errors': [{'message': f"Failed to decode `block.number` value: `subgraph Qm has only indexed up to "
+                                           f"block number {self.indexed_block} and data for block number "
+                                           f"{variables['block']} is therefore not yet available`"}]}
+
+        matches = [safe for safe in self.safes
+                   if safe['collateralType'] == variables['collateralType'] and Decimal(safe['debt']) > 0
+                   and safe['id'] > variables['lastId'] and ('upper' not in variables or safe['id'] <= variables['upper'])]
+
+        return {'data': {'safes': [{key: safe[key] for key in ['id', 'safeHandler', 'collateral', 'debt']}
+                                   for safe in matches[:variables['first']]]}}
+
+
+class GraphRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        body = json.dumps(self.server.answer(request['query'], request.get('variables', {}))).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def graph():
+    random.seed(1)
+    safes = []
+    for i in range(3000):
+        handler = '0x' + ''.join(random.choice('0123456789abcdef') for _ in range(40))
+        safes.append({
+            'id': handler,
+            'safeHandler': handler,
+            'collateralType': 'ETH-A' if i % 3 else 'ETH-B',
+            'collateral': str(Decimal(random.randint(1, 10**6)) / 1000),
+            'debt': '0' if i % 2 else str(Decimal(random.randint(1, 10**9)) / 1000)
+        })
+
+    server = GraphStandIn(safes)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestGraphSAFEHistory:
+
+    def test_id_ranges_cover_every_id(self):
+        ranges = GraphSAFEHistory.id_ranges()
+        assert len(ranges) == 16
+        for safe_id in ['', '0x', '0x0000', '0x0fff', '0x1', '0x9f', '0xa0', '0xffff', 'safe-1', 'zzz']:
+            covering = [r for r in ranges if safe_id > r[0] and (r[1] is None or safe_id <= r[1])]
+            assert len(covering) == (0 if safe_id == '' else 1)
+
+    def test_fetches_indebted_safes_only(self, graph: GraphStandIn):
+        history = GraphSAFEHistory(graph.endpoint, CollateralType('ETH-A'), page_size=50, max_workers=4)
+        safes = history.get_safes()
+
+        expected = [safe for safe in graph.safes if safe['collateralType'] == 'ETH-A' and safe['debt'] != '0']
+        assert len(safes) == len(expected)
+        for entity in expected:
+            safe = safes[Address(entity['safeHandler'])]
+            assert safe.collateral_type.name == 'ETH-A'
+            assert safe.locked_collateral == Wad(int(Decimal(entity['collateral']) * 10**18))
+            assert safe.generated_debt == Wad(int(Decimal(entity['debt']) * 10**18))
+
+        # One request per page, plus the final short page of each id range
+        assert len(graph.queries) <= len(expected) // 50 + 16
+
+    def test_queries_count_towards_the_calling_thread(self, graph: GraphStandIn):
+        reset_requests()
+        GraphSAFEHistory(graph.endpoint, CollateralType('ETH-A'), max_workers=4).get_safes()
+
+        assert requests_made() == {'graph': len(graph.queries)}
+
+    def test_graph_errors_are_raised(self, graph: GraphStandIn):
+        history = GraphSAFEHistory(graph.endpoint, CollateralType('ETH-A'))
+        history.page_size = 5000
+
+        with pytest.raises(RuntimeError):
+            history.get_safes()
+
+    def test_pages_are_read_at_the_pinned_block(self, graph: GraphStandIn):
+        history = GraphSAFEHistory(graph.endpoint, CollateralType('ETH-A'), block_number=1000)
+        history.get_safes()
+
+        assert all('block: {number: $block}' in query and variables['block'] == 1000
+                   for query, variables in graph.queries)
+
+    def test_waits_for_the_graph_to_index_the_pinned_block(self, graph: GraphStandIn):
+        assert GraphSAFEHistory.indexed_block(graph.endpoint) == 1000
+
+        timer = threading.Timer(0.3, lambda: setattr(graph, 'indexed_block', 1005))
+        timer.start()
+        history = GraphSAFEHistory(graph.endpoint, CollateralType('ETH-A'), block_number=1005, poll_interval=0.05)
+        safes = history.get_safes()
+        timer.join()
+
+        assert len(safes) == len([safe for safe in graph.safes if safe['collateralType'] == 'ETH-A' and safe['debt'] != '0'])
+
+    def test_graph_too_far_behind_is_raised(self, graph: GraphStandIn):
+        history = GraphSAFEHistory(graph.endpoint, CollateralType('ETH-A'), block_number=1005, index_wait=0.2,
+                                   poll_interval=0.05)
+
+        with pytest.raises(RuntimeError):
+            history.get_safes()
@@ -0,0 +1,177 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+import pytest
+
+from src.log_indexer import LogConsumer, LogIndexer, raw_get_logs
+from src.rpc import requests_made, reset_requests
+
+
+class FakeNode:
+    """ Serves logs at a few blocks and rejects ranges holding more than `max_results` of them """
+
+    def __init__(self, blocks: list, max_results: int = 5):
+        self.blocks = blocks
+        self.max_results = max_results
+        self.requests = []
+        self.fail_from = None
+        self.lock = threading.Lock()
+
+    def get_logs(self, params: dict) -> list:
+        with self.lock:
+            self.requests.append((params['fromBlock'], params['toBlock']))
+
+        if self.fail_from is not None and params['toBlock'] >= self.fail_from:
+            raise ConnectionError("node went away")
+
+        logs = [{'blockNumber': block} for block in self.blocks if params['fromBlock'] <= block <= params['toBlock']]
+        if len(logs) > self.max_results:
+            raise ValueError({'code': -32005, 'message': f'query returned more than {self.max_results} results'})
+
+        return logs
+
+
+class FakeProvider:
+    """ Answers `eth_getLogs` from a FakeNode, the way `raw_get_logs` calls a provider """
+
+    def __init__(self, node: FakeNode):
+        self.node = node
+
+    def make_request(self, method: str, params: list) -> dict:
+        assert method == 'eth_getLogs'
+        filter_params = dict(params[0], fromBlock=int(params[0]['fromBlock'], 16),
+                             toBlock=int(params[0]['toBlock'], 16))
+        try:
+            return {'result': self.node.get_logs(filter_params)}
+        except ValueError as e:
+            return {'error': e.args[0]}
+
+
+class BlockNumbers(LogConsumer):
+    def __init__(self):
+        self.blocks = []
+
+    def consume(self, logs: list):
+        self.blocks.extend(log['blockNumber'] for log in logs)
+
+    def to_checkpoint(self):
+        return self.blocks
+
+    def from_checkpoint(self, state):
+        self.blocks = list(state)
+
+
+class TestLogIndexer:
+
+    def test_scan_delivers_logs_in_order(self):
+        blocks = list(range(100, 200)) + [5000, 90000]
+        node = FakeNode(blocks)
+        consumer = BlockNumbers()
+
+        LogIndexer(node.get_logs, chunk_size=1000, max_workers=3).scan({}, 0, 100000, consumer)
+
+        assert consumer.blocks == blocks
+        # the dense range was split, the sparse tail needed only a few large requests
+        assert min(end - start for start, end in node.requests) < 5
+        assert max(end - start for start, end in node.requests) > 1000
+
+    def test_worker_requests_count_towards_the_scanning_thread(self):
+        node = FakeNode(list(range(100, 120)))
+        web3 = type('Web3', (), {'provider': FakeProvider(node)})()
+
+        reset_requests()
+        consumer = BlockNumbers()
+        LogIndexer(raw_get_logs(web3), chunk_size=10, max_workers=3).scan({}, 0, 1000, consumer)
+
+        assert consumer.blocks == list(range(100, 120))
+        assert requests_made() == {'eth_getLogs': len(node.requests)}
+
+    def test_unrelated_errors_are_raised(self):
+        node = FakeNode([10])
+        node.fail_from = 0
+
+        with pytest.raises(ConnectionError):
+            LogIndexer(node.get_logs, chunk_size=100).scan({}, 0, 1000, BlockNumbers())
+
+    def test_interrupted_scan_resumes_from_checkpoint(self, tmpdir):
+        blocks = list(range(0, 10000, 7))
+        checkpoint_file = str(tmpdir.join('checkpoint.json'))
+        node = FakeNode(blocks, max_results=1000)
+        node.fail_from = 6000
+
+        indexer = LogIndexer(node.get_logs, chunk_size=500, max_chunk_size=500, max_workers=1,
+                             checkpoint_file=checkpoint_file, checkpoint_interval=0)
+        with pytest.raises(ConnectionError):
+            indexer.scan({'address': '0x0'}, 0, 9999, BlockNumbers())
+
+        node.fail_from = None
+        node.requests = []
+        consumer = BlockNumbers()
+        indexer.scan({'address': '0x0'}, 0, 9999, consumer)
+
+        assert consumer.blocks == blocks
+        assert min(start for start, _ in node.requests) >= 5500
+
+        # a checkpoint of a different scan is ignored
+        consumer = BlockNumbers()
+        indexer.scan({'address': '0x1'}, 0, 9999, consumer)
+        assert consumer.blocks == blocks
+
+    def test_checkpoint_leaves_out_unconfirmed_blocks(self, tmpdir):
+        checkpoint_file = str(tmpdir.join('checkpoint.json'))
+        node = FakeNode(list(range(0, 1001, 5)), max_results=1000)
+        indexer = LogIndexer(node.get_logs, chunk_size=100, max_workers=2, checkpoint_file=checkpoint_file,
+                             checkpoint_interval=0, confirmations=12)
+
+        consumer = BlockNumbers()
+        indexer.scan({}, 0, 1000, consumer)
+        assert consumer.blocks == list(range(0, 1001, 5))
+
+        # Blocks past the confirmation depth are reorged away, and replaced by blocks with other logs
+        node.blocks = list(range(0, 989, 5)) + [993, 997]
+        node.requests = []
+        consumer = BlockNumbers()
+        indexer.scan({}, 0, 1000, consumer)
+
+        assert consumer.blocks == node.blocks
+        assert min(start for start, _ in node.requests) == 989
+
+    def test_checkpoint_past_the_end_of_a_scan_is_ignored(self, tmpdir):
+        checkpoint_file = str(tmpdir.join('checkpoint.json'))
+        node = FakeNode([100, 500, 900], max_results=1000)
+        indexer = LogIndexer(node.get_logs, chunk_size=100, checkpoint_file=checkpoint_file, confirmations=0)
+        indexer.scan({}, 0, 1000, BlockNumbers())
+
+        # A scan pinned to an earlier block than the checkpoint only sees logs up to that block
+        consumer = BlockNumbers()
+        indexer.scan({}, 0, 400, consumer)
+        assert consumer.blocks == [100]
+
+    def test_checkpoint_directory_is_created(self, tmpdir):
+        checkpoint_file = str(tmpdir.join('checkpoints', 'ETH-A-safes.json'))
+        node = FakeNode([100, 500, 900], max_results=1000)
+        LogIndexer(node.get_logs, chunk_size=100, checkpoint_file=checkpoint_file, checkpoint_interval=0,
+                   confirmations=0).scan({}, 0, 1000, BlockNumbers())
+        requests = len(node.requests)
+
+        # Resumed from the checkpoint, without asking for any more logs
+        consumer = BlockNumbers()
+        LogIndexer(node.get_logs, checkpoint_file=checkpoint_file, confirmations=0).scan({}, 0, 1000, consumer)
+        assert consumer.blocks == [100, 500, 900]
+        assert len(node.requests) == requests
@@ -0,0 +1,96 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pstats
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.profiling import PhaseProfiler
+from src.rpc import add_rpc_seconds, count_request, for_caller, timed_request
+
+
+class Phases:
+    def outer(self):
+        self.inner()
+        busy(0.05)
+
+    def inner(self):
+        count_request('eth_call')
+        add_rpc_seconds(0.2)
+        busy(0.05)
+
+
+def fetch():
+    with timed_request('eth_getLogs'):
+        time.sleep(0.05)
+
+
+def busy(seconds: float):
+    until = time.perf_counter() + seconds
+    while time.perf_counter() < until:
+        pass
+
+
+class TestPhaseProfiler:
+
+    def test_sampled_phases(self, tmpdir):
+        profiler = PhaseProfiler(str(tmpdir), 'sampling', interval=0.001)
+        phases = Phases()
+        profiler.wrap(phases, ['outer', 'inner'])
+
+        phases.outer()
+        profiler.close()
+
+        assert profiler.stats['outer'].calls == 1
+        assert profiler.stats['inner'].requests == 1
+        assert abs(profiler.stats['outer'].rpc_seconds - 0.2) < 0.001
+        assert profiler.stats['outer'].wall_seconds >= 0.1
+
+        with open(os.path.join(str(tmpdir), 'inner.collapsed')) as f:
+            stacks = [line.rsplit(' ', 1)[0] for line in f]
+        assert any(stack.endswith('test_profiling.py:inner;test_profiling.py:busy') for stack in stacks)
+        assert os.path.exists(os.path.join(str(tmpdir), 'summary.txt'))
+
+    def test_nested_phase_pauses_the_outer_profile(self, tmpdir):
+        profiler = PhaseProfiler(str(tmpdir), 'deterministic')
+        phases = Phases()
+        profiler.wrap(phases, ['outer', 'inner'])
+
+        phases.outer()
+        profiler.close()
+
+        outer = pstats.Stats(os.path.join(str(tmpdir), 'outer.pstats'))
+        inner = pstats.Stats(os.path.join(str(tmpdir), 'inner.pstats'))
+        assert [calls[0] for function, calls in outer.stats.items() if function[2] == 'busy'] == [1]
+        assert [calls[0] for function, calls in inner.stats.items() if function[2] == 'busy'] == [1]
+
+    def test_worker_requests_count_towards_the_phase(self, tmpdir):
+        profiler = PhaseProfiler(str(tmpdir), 'sampling', interval=0.001)
+
+        with profiler.phase('scan'):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                for future in [executor.submit(for_caller(fetch)) for _ in range(2)]:
+                    future.result()
+
+        assert profiler.stats['scan'].requests == 2
+        assert profiler.stats['scan'].rpc_seconds >= 0.1
+        # Only the summary is written as phases end, the profiles once the profiler is closed
+        assert os.listdir(str(tmpdir)) == ['summary.txt']
+
+        profiler.close()
+        assert sorted(os.listdir(str(tmpdir))) == ['scan.collapsed', 'summary.txt']
@@ -0,0 +1,205 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import threading
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from web3 import Web3, HTTPProvider
+from web3.providers import BaseProvider
+
+from pyflex import Address
+
+from src.rpc import StatusProbe, count_request, for_caller, pinned_block, pinned_block_middleware, pinned_to, \
+    requests_made, reset_requests
+from src.settlement_keeper import SettlementKeeper
+
+
+class NodeStandIn(HTTPServer):
+    """ Answers the status probe's requests, recording each HTTP request it receives """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), NodeRequestHandler)
+        self.requests = []
+        self.shutdown_time = 0
+
+    def answer(self, request: dict) -> dict:
+        if request['method'] == 'eth_getBlockByNumber':
+            result = {'number': '0x10', 'timestamp': hex(1600000000), 'hash': '0x' + '11' * 32}
+        else:
+            values = {StatusProbe.SELECTORS['contractEnabled']: int(self.shutdown_time == 0),
+                      StatusProbe.SELECTORS['shutdownTime']: self.shutdown_time,
+                      StatusProbe.SELECTORS['shutdownCooldown']: 3600}
+            result = '0x' + values[request['params'][0]['data']].to_bytes(32, 'big').hex()
+
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+
+
+class LocalProvider(BaseProvider):
+    """ Hands requests to a NodeStandIn one at a time, the way an IPC or websocket provider would """
+
+    def __init__(self, node: NodeStandIn):
+        self.node = node
+
+    def make_request(self, method, params):
+        return self.node.answer({'method': method, 'params': params, 'id': 1})
+
+
+class NodeRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(request)
+        response = [self.server.answer(r) for r in request] if isinstance(request, list) else self.server.answer(request)
+        body = json.dumps(response).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def node():
+    server = NodeStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestPinnedBlock:
+
+    def setup_method(self):
+        self.requests = []
+        self.middleware = pinned_block_middleware(lambda method, params: self.requests.append((method, params)), None)
+
+    def test_reads_are_unchanged_when_not_pinned(self):
+        self.middleware('eth_call', [{'to': '0x01'}, 'latest'])
+
+        assert self.requests == [('eth_call', [{'to': '0x01'}, 'latest'])]
+
+    def test_latest_reads_are_pinned(self):
+        with pinned_to(100):
+            self.middleware('eth_call', [{'to': '0x01'}, 'latest'])
+            self.middleware('eth_getBalance', ['0x01'])
+            self.middleware('eth_getStorageAt', ['0x01', '0x0', 'latest'])
+            self.middleware('eth_call', [{'to': '0x01'}, '0x10'])
+            self.middleware('eth_blockNumber', [])
+
+        assert self.requests == [('eth_call', [{'to': '0x01'}, '0x64']),
+                                 ('eth_getBalance', ['0x01', '0x64']),
+                                 ('eth_getStorageAt', ['0x01', '0x0', '0x64']),
+                                 ('eth_call', [{'to': '0x01'}, '0x10']),
+                                 ('eth_blockNumber', [])]
+
+    def test_pins_nest_and_are_per_thread(self):
+        seen = []
+        with pinned_to(100):
+            with pinned_to(90):
+                thread = threading.Thread(target=lambda: seen.append(pinned_block()))
+                thread.start()
+                thread.join()
+                assert pinned_block() == 90
+            assert pinned_block() == 100
+
+        assert pinned_block() is None
+        assert seen == [None]
+
+
+class TestStatusProbe:
+
+    def test_one_request_per_probe(self, node: NodeStandIn):
+        web3 = Web3(HTTPProvider(f'http://127.0.0.1:{node.server_address[1]}'))
+        probe = StatusProbe(web3, Address('0x' + '22' * 20))
+        reset_requests()
+
+        status = probe.probe()
+        assert status.block_number == 16
+        assert status.timestamp == 1600000000
+        assert status.contract_enabled
+        assert status.shutdown_time == 0
+
+        node.shutdown_time = 1500000000
+        status = probe.probe()
+        assert not status.contract_enabled
+        assert status.shutdown_time == 1500000000
+        assert status.shutdown_cooldown == 3600
+
+        # Once shutdown, only the block and contractEnabled are asked for
+        probe.probe()
+        assert [len(request) for request in node.requests] == [4, 4, 2]
+        assert requests_made() == {'batch': 3}
+
+    def test_separate_requests_are_counted(self, node: NodeStandIn):
+        probe = StatusProbe(Web3(LocalProvider(node)), Address('0x' + '22' * 20))
+        reset_requests()
+
+        assert probe.probe().block_number == 16
+        assert requests_made() == {'eth_getBlockByNumber': 1, 'eth_call': 3}
+
+
+def budgeted_keeper(rpc_budget: int, requests_per_block: int) -> SettlementKeeper:
+    """ A keeper whose settlement check makes `requests_per_block` requests, half of them on worker threads """
+    def check_settlement():
+        for _ in range(requests_per_block // 2):
+            count_request('eth_call')
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(for_caller(lambda _: count_request('eth_getLogs')),
+                              range(requests_per_block - requests_per_block // 2)))
+
+        # Like pyflex's Lifecycle watching for blocks, a thread of its own isn't counted
+        watcher = threading.Thread(target=lambda: count_request('eth_getBlockByNumber'))
+        watcher.start()
+        watcher.join()
+
+    keeper = SettlementKeeper.__new__(SettlementKeeper)
+    keeper.arguments = Namespace(rpc_budget=rpc_budget)
+    keeper.errors = 0
+    keeper.max_errors = 100
+    keeper.check_settlement = check_settlement
+    return keeper
+
+
+class TestRpcBudget:
+
+    def test_requests_over_the_budget_are_reported(self, caplog):
+        keeper = budgeted_keeper(rpc_budget=5, requests_per_block=6)
+
+        with caplog.at_level(logging.WARNING):
+            keeper.process_block()
+
+        assert requests_made() == {'eth_call': 3, 'eth_getLogs': 3}
+        assert [record.getMessage() for record in caplog.records] == [
+            "Made 6 requests this block, over the budget of 5: {'eth_call': 3, 'eth_getLogs': 3}"]
+
+    def test_counts_start_over_each_block(self, caplog):
+        keeper = budgeted_keeper(rpc_budget=5, requests_per_block=4)
+
+        with caplog.at_level(logging.WARNING):
+            keeper.process_block()
+            keeper.process_block()
+
+        assert requests_made() == {'eth_call': 2, 'eth_getLogs': 2}
+        assert caplog.records == []
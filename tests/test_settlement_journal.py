@@ -0,0 +1,221 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import time
+
+import pytest
+from web3.exceptions import TransactionNotFound
+
+from src.settlement_journal import SettlementJournal
+from src.settlement_keeper import SettlementKeeper
+
+
+class Crash(Exception):
+    pass
+
+
+class FakeTransact:
+    """ Sends a transaction the way pyflex's Transact does, recording its hash in `tx_hashes` """
+
+    def __init__(self, node, key: str):
+        self.node = node
+        self.key = key
+        self.tx_hashes = []
+
+    async def transact_async(self, gas_price=None):
+        tx_hash = f'0x{len(self.node.sent) + 1:064x}'
+        self.tx_hashes.append(tx_hash)
+        self.node.sent.append(self.key)
+        await asyncio.sleep(0)
+
+        if self.key in self.node.crash_on:
+            raise Crash(self.key)
+        if self.key in self.node.revert:
+            return None
+
+        self.node.receipts[tx_hash] = 1
+        return type('Receipt', (), {'transaction_hash': tx_hash})
+
+
+class FakeNode:
+    def __init__(self):
+        self.sent = []
+        self.receipts = {}
+        self.crash_on = set()
+        self.revert = set()
+        self.eth = self
+
+    def getTransactionReceipt(self, tx_hash):
+        if tx_hash not in self.receipts:
+            raise TransactionNotFound(tx_hash)
+        return type('Receipt', (), {'status': self.receipts[tx_hash]})
+
+
+def journaling_keeper(node: FakeNode, path: str) -> SettlementKeeper:
+    """ A keeper with only what sending journaled actions needs, talking to a fake node """
+    keeper = SettlementKeeper.__new__(SettlementKeeper)
+    keeper.web3 = node
+    keeper.gas_price = None
+    keeper.journal = SettlementJournal(path)
+    keeper.attempted = set()
+    keeper.settlement_transaction = lambda action, params: FakeTransact(node, SettlementJournal.key(action, params))
+    keeper.reconcile_journal()
+    return keeper
+
+
+class TestSettlementJournal:
+
+    def test_in_memory_journal(self):
+        journal = SettlementJournal()
+        key = journal.plan('freeze_collateral_type', ['ETH-A'])
+
+        assert key == 'freeze_collateral_type:ETH-A'
+        assert journal.status(key) == SettlementJournal.PLANNED
+        assert journal.pending() == [key]
+
+        journal.mined(key, '0x01')
+        assert journal.pending() == []
+
+    def test_replay_restores_state_and_pending_actions(self, tmpdir):
+        path = str(tmpdir.join('journal.jsonl'))
+
+        journal = SettlementJournal(path)
+        journal.set('confirmations', 12)
+        freeze = journal.plan('freeze_collateral_type', ['ETH-A'])
+        process = journal.plan('process_safe', ['ETH-A', '0x00000000000000000000000000000000000000aa'])
+        cash_price = journal.plan('calculate_cash_price', ['ETH-A'])
+        journal.sent(freeze, '0x01')
+        journal.mined(freeze, '0x01')
+        journal.sent(process, '0x02')
+        journal.failed(cash_price)
+        journal.close()
+
+        resumed = SettlementJournal(path)
+        assert resumed.state == {'confirmations': 12}
+        assert resumed.pending() == [process, cash_price]
+        assert resumed.status(process) == SettlementJournal.SENT
+        assert resumed.actions[process]['tx_hashes'] == ['0x02']
+        assert resumed.actions[process]['params'] == ['ETH-A', '0x00000000000000000000000000000000000000aa']
+
+        # planning an action again doesn't reset its progress
+        assert resumed.plan('freeze_collateral_type', ['ETH-A']) == freeze
+        assert resumed.status(freeze) == SettlementJournal.MINED
+
+    def test_record_cut_short_by_a_crash_is_skipped(self, tmpdir):
+        path = str(tmpdir.join('journal.jsonl'))
+
+        journal = SettlementJournal(path)
+        journal.plan('set_outstanding_coin_supply', [])
+        journal.close()
+        with open(path, 'a') as f:
+            f.write('{"type": "mined", "key": "set_outst')
+
+        resumed = SettlementJournal(path)
+        assert resumed.pending() == ['set_outstanding_coin_supply']
+        resumed.mined('set_outstanding_coin_supply', '0x03')
+        resumed.close()
+
+        assert SettlementJournal(path).pending() == []
+
+    def test_replay_is_fast(self, tmpdir):
+        path = str(tmpdir.join('journal.jsonl'))
+        with open(path, 'w') as f:
+            for i in range(10000):
+                params = ['ETH-A', f'0x{i:040x}']
+                key = SettlementJournal.key('process_safe', params)
+                f.write(json.dumps({'type': 'planned', 'key': key, 'action': 'process_safe', 'params': params}) + '\n')
+                if i % 2:
+                    f.write(json.dumps({'type': 'mined', 'key': key, 'tx_hash': f'0x{i:064x}'}) + '\n')
+
+        started = time.time()
+        resumed = SettlementJournal(path)
+        assert len(resumed.pending()) == 5000
+        assert time.time() - started < 1
+
+
+class TestSettlementKeeperJournal:
+
+    def test_resume_after_crash(self, tmpdir):
+        path = str(tmpdir.join('journal.jsonl'))
+        node = FakeNode()
+        node.crash_on = {'process_safe:ETH-A:0x02'}
+
+        keeper = journaling_keeper(node, path)
+        for address in ['0x01', '0x02', '0x03']:
+            keeper.journal.plan('process_safe', ['ETH-A', address])
+
+        # The keeper dies after broadcasting the second transaction, before seeing it mined
+        with pytest.raises(Crash):
+            keeper.send_pending()
+        keeper.journal.close()
+        node.receipts[f'0x{2:064x}'] = 1
+
+        node.crash_on = set()
+        keeper = journaling_keeper(node, path)
+        assert keeper.journal.pending() == ['process_safe:ETH-A:0x03']
+
+        keeper.send_pending()
+        assert keeper.journal.pending() == []
+        assert node.sent == ['process_safe:ETH-A:0x01', 'process_safe:ETH-A:0x02', 'process_safe:ETH-A:0x03']
+
+    def test_sent_transaction_not_mined_is_sent_again(self, tmpdir):
+        path = str(tmpdir.join('journal.jsonl'))
+        node = FakeNode()
+        node.crash_on = {'freeze_collateral_type:ETH-A'}
+
+        keeper = journaling_keeper(node, path)
+        with pytest.raises(Crash):
+            keeper.send('freeze_collateral_type', ['ETH-A'])
+        keeper.journal.close()
+        assert SettlementJournal(path).actions['freeze_collateral_type:ETH-A']['tx_hashes'] == [f'0x{1:064x}']
+
+        # Nothing was mined, so the resumed keeper sends the action again
+        node.crash_on = set()
+        keeper = journaling_keeper(node, path)
+        keeper.send_pending()
+        assert keeper.journal.pending() == []
+        assert node.sent == ['freeze_collateral_type:ETH-A', 'freeze_collateral_type:ETH-A']
+
+    def test_failed_actions_keep_the_processing_period_open(self, tmpdir):
+        path = str(tmpdir.join('journal.jsonl'))
+        node = FakeNode()
+        node.revert = {'process_safe:ETH-A:0x01'}
+
+        keeper = journaling_keeper(node, path)
+        keeper.journal.set('auctions_planned', True)
+        keeper.journal.set('safes_planned', True)
+        keeper.journal.plan('process_safe', ['ETH-A', '0x01'])
+        keeper.facilitate_processing_period()
+        keeper.journal.close()
+        assert 'processing_period_complete' not in SettlementJournal(path).state
+
+        node.revert = set()
+        keeper = journaling_keeper(node, path)
+        keeper.facilitate_processing_period()
+        assert keeper.journal.state['processing_period_complete']
+        assert node.sent == ['process_safe:ETH-A:0x01', 'process_safe:ETH-A:0x01']
+
+    def test_transactions_without_hashes_are_refused(self, tmpdir):
+        node = FakeNode()
+        keeper = journaling_keeper(node, str(tmpdir.join('journal.jsonl')))
+        keeper.settlement_transaction = lambda action, params: object()
+
+        with pytest.raises(RuntimeError):
+            keeper.send('set_outstanding_coin_supply', [])
+        assert node.sent == []
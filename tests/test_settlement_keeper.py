@@ -293,6 +293,15 @@ class TestSettlementKeeper:
         print_out("test_check_deployment")
         keeper.check_deployment()
 
+    def test_lazy_deployment(self, geb: GfDeployment, keeper: SettlementKeeper):
+        print_out("test_lazy_deployment")
+        for name in ['safe_engine', 'accounting_engine', 'oracle_relayer', 'surplus_auction_house',
+                     'debt_auction_house', 'tax_collector', 'global_settlement']:
+            assert keeper.geb.address(name) == getattr(geb, name).address
+            assert getattr(keeper.geb, name).address == getattr(geb, name).address
+
+        assert keeper.geb.collaterals.keys() == geb.collaterals.keys()
+
     def test_get_underwater_safes(self, geb: GfDeployment, keeper: SettlementKeeper, guy_address: Address, our_address: Address):
         print_out("test_get_underwater_safes")
         collateral_types = keeper.get_collateral_types()
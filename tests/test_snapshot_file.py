@@ -0,0 +1,204 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+import pytest
+from web3 import Web3
+from web3.providers import BaseProvider
+
+from pyflex import Address
+from pyflex.gf import CollateralType, SAFE
+from pyflex.numeric import Wad, Ray
+
+from src.rpc import Status
+from src.settlement_keeper import SettlementKeeper
+from src.snapshot_file import SnapshotFile
+
+BLOCK_HASH = '0x' + 'ab' * 32
+
+
+def collateral_type(name: str) -> CollateralType:
+    collateral_type = CollateralType(name)
+    collateral_type.accumulated_rate = Ray.from_number(1.05)
+    collateral_type.safety_price = Ray.from_number(150)
+    collateral_type.safe_debt = Wad.from_number(1000000)
+    return collateral_type
+
+
+def safes(collateral_type: CollateralType, count: int) -> list:
+    return [SAFE(Address(f'0x{i + 1:040x}'), collateral_type, Wad(10**18 * (i + 1)), Wad(2**200 + i))
+            for i in range(count)]
+
+
+class PrunedNode(BaseProvider):
+    """ Serves block headers, but no state at past blocks, like a node which isn't an archive node """
+
+    def __init__(self, block_number: int, block_hash: str, timestamp: int):
+        self.blocks = {block_number: {'number': hex(block_number), 'hash': block_hash, 'timestamp': hex(timestamp)}}
+        self.methods = []
+
+    def make_request(self, method, params):
+        self.methods.append(method)
+        if method == 'eth_getBlockByNumber':
+            return {'result': self.blocks.get(int(params[0], 16))}
+
+        return {'error': {'code': -32000, 'message': 'missing trie node'}}
+
+
+class ShutdownProbe:
+    def __init__(self, shutdown_time: int):
+        self.shutdown_time = shutdown_time
+
+    def probe(self) -> Status:
+        return Status(2000, 1600100000, self.shutdown_time == 0, self.shutdown_time, 3600)
+
+
+def loading_keeper(node: PrunedNode, shutdown_time: int) -> SettlementKeeper:
+    """ A keeper with only what loading a snapshot file needs, talking to a node without past state """
+    keeper = SettlementKeeper.__new__(SettlementKeeper)
+    keeper.web3 = Web3(node)
+    keeper.status_probe = ShutdownProbe(shutdown_time)
+    keeper.snapshots = {}
+    keeper.imported_snapshot = None
+    return keeper
+
+
+class TestSnapshotFile:
+
+    def test_round_trip(self, tmpdir):
+        path = str(tmpdir.join('snapshot.bin'))
+        eth_a, eth_b = collateral_type('ETH-A'), collateral_type('ETH-B')
+        auction_ids = {'collateral_auctions': {'ETH-A': [3, 4]}, 'surplus_auctions': [1], 'debt_auctions': []}
+
+        SnapshotFile.write(path, 1234, BLOCK_HASH,
+                           [(eth_a, Ray.from_number(1.5), safes(eth_a, 3)), (eth_b, Ray.from_number(2), [])],
+                           auction_ids)
+
+        snapshot = SnapshotFile(path)
+        assert snapshot.block_number == 1234
+        assert snapshot.block_hash == bytes.fromhex('ab' * 32)
+        assert snapshot.auction_ids == auction_ids
+        assert snapshot.collateral_type_names == ['ETH-A', 'ETH-B']
+        assert snapshot.collateral_type('ETH-A').accumulated_rate == eth_a.accumulated_rate
+        assert snapshot.collateral_type('ETH-A').safe_debt == eth_a.safe_debt
+        assert snapshot.safety_c_ratio('ETH-B') == Ray.from_number(2)
+
+        loaded = list(snapshot.safes('ETH-A'))
+        assert [safe.address for safe in loaded] == [safe.address for safe in safes(eth_a, 3)]
+        assert [safe.generated_debt for safe in loaded] == [Wad(2**200), Wad(2**200 + 1), Wad(2**200 + 2)]
+        assert len(snapshot.column('ETH-A', 'locked_collateral')) == 3 * SnapshotFile.AMOUNT_SIZE
+        assert list(snapshot.safes('ETH-B')) == []
+        snapshot.close()
+
+    def test_other_files_are_refused(self, tmpdir):
+        path = str(tmpdir.join('snapshot.bin'))
+        with open(path, 'wb') as f:
+            f.write(b'{"block_number": 1234}' + bytes(64))
+
+        with pytest.raises(ValueError):
+            SnapshotFile(path)
+
+    def test_opening_a_large_snapshot_is_fast(self, tmpdir):
+        path = str(tmpdir.join('snapshot.bin'))
+        eth_a = collateral_type('ETH-A')
+        SnapshotFile.write(path, 1234, BLOCK_HASH, [(eth_a, Ray.from_number(1.5), safes(eth_a, 100000))], {})
+
+        started = time.time()
+        snapshot = SnapshotFile(path)
+        assert len(snapshot.column('ETH-A', 'address')) == 100000 * SnapshotFile.ADDRESS_SIZE
+        assert time.time() - started < 0.1
+        snapshot.close()
+
+    @pytest.mark.parametrize('contents', [b'', b'GEBSNAP\x00'])
+    def test_files_shorter_than_the_header_are_refused(self, tmpdir, contents: bytes):
+        path = str(tmpdir.join('snapshot.bin'))
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+        with pytest.raises(ValueError, match='too short'):
+            SnapshotFile(path)
+
+    def test_truncated_snapshot_is_refused(self, tmpdir):
+        path = str(tmpdir.join('snapshot.bin'))
+        eth_a = collateral_type('ETH-A')
+        SnapshotFile.write(path, 1234, BLOCK_HASH, [(eth_a, Ray.from_number(1.5), safes(eth_a, 4))], {})
+
+        # A partial copy, missing the debt of the last two SAFEs
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 2 * SnapshotFile.AMOUNT_SIZE)
+
+        with pytest.raises(ValueError, match='truncated'):
+            SnapshotFile(path)
+
+    def test_corrupt_snapshot_is_refused(self, tmpdir):
+        path = str(tmpdir.join('snapshot.bin'))
+        eth_a = collateral_type('ETH-A')
+        SnapshotFile.write(path, 1234, BLOCK_HASH, [(eth_a, Ray.from_number(1.5), safes(eth_a, 4))], {})
+
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 1]))
+
+        with pytest.raises(ValueError, match='checksum'):
+            SnapshotFile(path)
+
+
+class TestLoadingSnapshotFiles:
+
+    def write(self, tmpdir) -> str:
+        path = str(tmpdir.join('snapshot.bin'))
+        eth_a = collateral_type('ETH-A')
+        SnapshotFile.write(path, 1234, BLOCK_HASH, [(eth_a, Ray.from_number(1.5), safes(eth_a, 4))], {})
+        return path
+
+    def test_snapshot_after_shutdown_is_used(self, tmpdir):
+        node = PrunedNode(1234, BLOCK_HASH, 1600000000)
+        keeper = loading_keeper(node, shutdown_time=1600000000)
+
+        keeper.load_snapshot_file(self.write(tmpdir))
+
+        assert keeper.imported_snapshot.block_number == 1234
+        assert 'eth_call' not in node.methods
+
+    @pytest.mark.parametrize('shutdown_time', [0, 1600000001])
+    def test_snapshot_before_shutdown_is_ignored(self, tmpdir, shutdown_time: int):
+        keeper = loading_keeper(PrunedNode(1234, BLOCK_HASH, 1600000000), shutdown_time)
+
+        keeper.load_snapshot_file(self.write(tmpdir))
+        assert keeper.imported_snapshot is None
+
+    @pytest.mark.parametrize('block_number, block_hash', [(1234, '0x' + 'cd' * 32), (1000, BLOCK_HASH)])
+    def test_snapshot_of_a_replaced_block_is_ignored(self, tmpdir, block_number: int, block_hash: str):
+        keeper = loading_keeper(PrunedNode(block_number, block_hash, 1600000000), shutdown_time=1500000000)
+
+        keeper.load_snapshot_file(self.write(tmpdir))
+        assert keeper.imported_snapshot is None
+
+    @pytest.mark.parametrize('cut', [None, 0, 10, 2 * SnapshotFile.AMOUNT_SIZE])
+    def test_unreadable_snapshot_is_ignored(self, tmpdir, cut):
+        path = self.write(tmpdir) if cut is not None else str(tmpdir.join('missing.bin'))
+        if cut is not None:
+            with open(path, 'r+b') as f:
+                f.truncate(cut if cut < SnapshotFile.HEADER.size else os.path.getsize(path) - cut)
+
+        keeper = loading_keeper(PrunedNode(1234, BLOCK_HASH, 1600000000), shutdown_time=1500000000)
+        keeper.load_snapshot_file(path)
+        assert keeper.imported_snapshot is None
@@ -0,0 +1,56 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from src.settlement_keeper import SettlementKeeper, int_between
+
+# Modules loading contract ABIs or building the deployment, which only the phases using them import
+DEFERRED_MODULES = ['pyflex.gf', 'pyflex.auctions', 'pyflex.shutdown', 'pyflex.deployment', 'auction_keeper.gas',
+                    'src.graph_safe_history', 'src.safe_log_history', 'src.snapshot_file', 'src.underwater_index']
+
+
+class TestStartup:
+
+    def test_keeper_module_defers_contract_imports(self):
+        # In a fresh interpreter, as other tests import these modules
+        code = f'import sys, src.settlement_keeper; print([m for m in {DEFERRED_MODULES} if m in sys.modules])'
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+
+        assert output.decode().strip() == '[]'
+
+
+class TestArguments:
+
+    def test_bounds_are_inclusive(self):
+        assert int_between(1, 1000)('1') == 1
+        assert int_between(1, 1000)('1000') == 1000
+        assert int_between(1)('64') == 64
+
+    @pytest.mark.parametrize('argument, value', [('--graph-page-size', '5000'), ('--graph-page-size', '0'),
+                                                 ('--log-chunk-size', '0'), ('--max-workers', '0'),
+                                                 ('--max-workers', 'four')])
+    def test_out_of_range_values_stop_the_keeper(self, argument: str, value: str, capsys):
+        with pytest.raises(SystemExit):
+            SettlementKeeper(['--network', 'testnet', '--eth-from', '0x' + '11' * 20, argument, value])
+
+        assert argument in capsys.readouterr().err
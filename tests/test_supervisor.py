@@ -0,0 +1,141 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+from argparse import Namespace
+
+import pytest
+
+from src.supervisor import SettlementSupervisor
+
+
+class FakeChain:
+    """ Mines a block every time its block number is read """
+
+    def __init__(self):
+        self.block_number = 0
+        self.eth = self
+
+    @property
+    def blockNumber(self) -> int:
+        self.block_number += 1
+        return self.block_number
+
+
+class StubKeeper:
+    """ Handles blocks like SettlementKeeper.process_block, stopping by itself after `blocks` blocks """
+
+    def __init__(self, web3: FakeChain, blocks: int, fail: bool = False, delay: float = 0.0, **arguments):
+        self.web3 = web3
+        self.arguments = Namespace(**dict({'rpc_uri': 'http://localhost:8545', 'export_snapshot': None,
+                                           'journal_file': None, 'log_checkpoint_dir': None, 'profile': None},
+                                          **arguments))
+        self.blocks = blocks
+        self.fail = fail
+        self.delay = delay
+        self.handled = 0
+        self.errors = 0
+        self.max_errors = 3
+        self.profiler = None
+        self.lifecycle = None
+        self.deployment_checked = False
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    def check_deployment(self):
+        self.deployment_checked = True
+
+    def process_block(self):
+        if self.errors >= self.max_errors:
+            self.lifecycle.terminate()
+            return
+
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        try:
+            time.sleep(self.delay)
+            self.handled += 1
+            if self.fail:
+                raise RuntimeError('node rejected the request')
+            if self.handled >= self.blocks:
+                self.lifecycle.terminate()
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def supervisor(tmpdir) -> SettlementSupervisor:
+    config = str(tmpdir.join('supervisor.json'))
+    with open(config, 'w') as f:
+        json.dump({'deployments': []}, f)
+
+    return SettlementSupervisor(['--config', config, '--poll-interval', '0.01'])
+
+
+class TestSettlementSupervisor:
+
+    def test_failing_deployment_is_terminated_alone(self, supervisor: SettlementSupervisor):
+        chain = FakeChain()
+        failing = StubKeeper(chain, blocks=1000, fail=True)
+        healthy = [StubKeeper(chain, blocks=20), StubKeeper(chain, blocks=20)]
+        supervisor.add('failing', failing)
+        for i, keeper in enumerate(healthy):
+            supervisor.add(f'healthy-{i}', keeper)
+
+        supervisor.main()
+
+        assert failing.lifecycle.terminated
+        assert failing.errors == failing.max_errors
+        assert all(keeper.deployment_checked for keeper in healthy + [failing])
+        assert [keeper.handled for keeper in healthy] == [20, 20]
+
+    def test_busy_keeper_skips_blocks(self, supervisor: SettlementSupervisor):
+        chain = FakeChain()
+        slow = StubKeeper(chain, blocks=3, delay=0.1)
+        fast = StubKeeper(chain, blocks=20)
+        supervisor.add('slow', slow)
+        supervisor.add('fast', fast)
+
+        supervisor.main()
+
+        # The slow keeper holds up neither the fast one nor the block poll, and never handles two blocks at once
+        assert fast.handled == 20
+        assert slow.handled == 3
+        assert slow.most_active == 1
+        assert chain.block_number > slow.handled + 3
+
+    def test_export_snapshot_is_refused(self, supervisor: SettlementSupervisor):
+        with pytest.raises(ValueError):
+            supervisor.add('export', StubKeeper(FakeChain(), blocks=1, export_snapshot='/tmp/snapshot.bin'))
+
+    @pytest.mark.parametrize('option', ['journal_file', 'log_checkpoint_dir', 'profile'])
+    def test_shared_paths_are_refused(self, supervisor: SettlementSupervisor, option: str, tmpdir):
+        supervisor.add('first', StubKeeper(FakeChain(), blocks=1, **{option: str(tmpdir.join('shared'))}))
+        supervisor.add('second', StubKeeper(FakeChain(), blocks=1, **{option: str(tmpdir.join('other'))}))
+
+        with pytest.raises(ValueError, match='already used by first'):
+            supervisor.add('third', StubKeeper(FakeChain(), blocks=1, **{option: str(tmpdir.join('.', 'shared'))}))
+
+    def test_one_keeper_can_not_use_a_path_twice(self, supervisor: SettlementSupervisor, tmpdir):
+        with pytest.raises(ValueError):
+            supervisor.add('first', StubKeeper(FakeChain(), blocks=1, journal_file=str(tmpdir.join('state')),
+                                               profile=str(tmpdir.join('state'))))
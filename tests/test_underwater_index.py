@@ -0,0 +1,84 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from pyflex import Address
+from pyflex.gf import CollateralType, SAFE
+from pyflex.numeric import Wad, Ray
+
+from src.underwater_index import UnderwaterIndex
+
+
+def safe(index: int, locked_collateral: float, generated_debt: float) -> SAFE:
+    return SAFE(Address(f"0x{index:040x}"), CollateralType('ETH-A'),
+                Wad.from_number(locked_collateral), Wad.from_number(generated_debt))
+
+
+def is_underwater(safe: SAFE, accumulated_rate: Ray, safety_price: Ray, safety_c_ratio: Ray) -> bool:
+    debt = Ray(safe.generated_debt) * accumulated_rate
+    collateral = Ray(safe.locked_collateral) * safety_price * safety_c_ratio
+    return debt > collateral
+
+
+class TestUnderwaterIndex:
+
+    def setup_method(self):
+        self.safes = [safe(1, 10, 1000), safe(2, 20, 1000), safe(3, 30, 1000), safe(4, 5, 0), safe(5, 40, 1000)]
+        self.index = UnderwaterIndex(CollateralType('ETH-A'))
+        for s in self.safes:
+            self.index.update(s)
+
+    def test_safes_without_debt_are_not_indexed(self):
+        assert len(self.index) == 4
+        assert Address(f"0x{4:040x}") not in self.index
+        assert self.index.underwater(Ray.from_number(1), Ray(0), Ray.from_number(1.5)) == \
+            [self.safes[0], self.safes[1], self.safes[2], self.safes[4]]
+
+    def test_underwater_matches_per_safe_check(self):
+        accumulated_rate = Ray.from_number(1.05)
+        safety_c_ratio = Ray.from_number(1.5)
+        for price in [10, 25, 50, 70, 100, 200]:
+            safety_price = Ray.from_number(price)
+            expected = [s for s in self.safes if is_underwater(s, accumulated_rate, safety_price, safety_c_ratio)]
+            underwater = self.index.underwater(accumulated_rate, safety_price, safety_c_ratio)
+            assert sorted(s.address.address for s in underwater) == sorted(s.address.address for s in expected)
+
+    def test_boundary_is_not_underwater(self):
+        # 20 collateral * 50 price == 1000 debt, so the second safe is exactly at its limit
+        underwater = self.index.underwater(Ray.from_number(1), Ray.from_number(50), Ray.from_number(1))
+        assert underwater == [self.safes[0]]
+
+    def test_update_repositions_safe(self):
+        prices = (Ray.from_number(1), Ray.from_number(40), Ray.from_number(1))
+        assert self.index.count_underwater(*prices) == 2
+
+        self.index.update(safe(1, 100, 1000))
+        assert self.index.underwater(*prices) == [self.safes[1]]
+
+        self.index.update(safe(2, 20, 0))
+        assert len(self.index) == 3
+        assert self.index.count_underwater(*prices) == 0
+
+        self.index.remove(Address(f"0x{3:040x}"))
+        assert len(self.index) == 2
+
+    def test_from_safes_matches_updates(self):
+        index = UnderwaterIndex.from_safes(CollateralType('ETH-A'), reversed(self.safes))
+
+        assert len(index) == 4
+        assert index.safes() == self.index.safes()
+        assert index.underwater(Ray.from_number(1), Ray.from_number(40), Ray.from_number(1)) == \
+            [self.safes[0], self.safes[1]]